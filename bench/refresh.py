@@ -0,0 +1,102 @@
+"""
+Benchmark the sync and the bulk commands of the plugin against the local Mattermost and LDAP stand-ins
+
+Usage: python bench/refresh.py [--courses 100] [--students 5000] [--teams 1000] [--latency 0.005]
+
+It needs the same environment as the plugin, run it from the plugin directory.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standin import FakeDirectory, FakeMattermost, bench_plugin, change_feed  # noqa: E402
+
+
+def run(name, mattermost, directory, func):
+    """Time the scenario and count the API calls and LDAP queries it makes"""
+    calls = sum(mattermost.calls.values())
+    queries = directory.queries
+    start = time.monotonic()
+    func()
+    elapsed = time.monotonic() - start
+    print('{:<32} {:>9.2f} {:>10} {:>10}'.format(
+        name, elapsed, sum(mattermost.calls.values()) - calls, directory.queries - queries))
+
+
+def wait(job):
+    if job is not None:
+        job.future.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--courses', type=int, default=100, help='number of course mappings')
+    parser.add_argument('--students', type=int, default=5000, help='number of students in the directory')
+    parser.add_argument('--teams', type=int, default=1000, help='number of existing teams not mapped to courses')
+    parser.add_argument('--course-load', type=int, default=5, help='number of courses a student takes')
+    parser.add_argument('--latency', type=float, default=0.005, help='latency of a Mattermost API call in seconds')
+    parser.add_argument('--ldap-latency', type=float, default=0.01, help='latency of a LDAP query in seconds')
+    parser.add_argument('--churn', type=float, default=0.02, help='fraction of the students changing sections')
+    parser.add_argument('--changed', type=float, default=0.1,
+                        help='fraction of the sections changing before the change-driven sync')
+    parser.add_argument('--bulk-users', type=int, default=200, help='number of users added by the bulk command')
+    parser.add_argument('--workers', type=int, default=4, help='SYNC_WORKERS of the plugin')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='requests per second allowed by the server, 0 for no limit like a default Mattermost')
+    parser.add_argument('--burst', type=int, default=100, help='burst of requests allowed by the server')
+    parser.add_argument('--mm-rate-limit', type=int, default=None,
+                        help='MM_RATE_LIMIT of the plugin, the shipped default when not given')
+    parser.add_argument('--mm-rate-burst', type=int, default=None,
+                        help='MM_RATE_BURST of the plugin, the shipped default when not given')
+    args = parser.parse_args()
+
+    # the plugin runs with its shipped rate limit unless told otherwise
+    limits = dict((k, v) for k, v in (('MM_RATE_LIMIT', args.mm_rate_limit), ('MM_RATE_BURST', args.mm_rate_burst))
+                  if v is not None)
+    mattermost = FakeMattermost(args.latency, args.rate_limit, args.burst)
+    for i in range(args.teams):
+        mattermost.add_team('bench-team-{:05d}'.format(i))
+    mattermost.start()
+    directory = FakeDirectory(args.courses, args.students, args.course_load, latency=args.ldap_latency)
+    courses = directory.course_specs
+
+    print('{} courses, {} students, {} teams, {}s API latency, {}s LDAP latency, server rate limit {}'.format(
+        args.courses, args.students, args.teams, args.latency, args.ldap_latency,
+        '{}/s burst {}'.format(args.rate_limit, args.burst) if args.rate_limit else 'off'))
+    try:
+        # the output of the bulk commands is not sent as a file, the test backend would keep it
+        with bench_plugin(mattermost, directory, SYNC_WORKERS=args.workers, LDAP_CACHE_TTL=0, SYNC_ATTACH_OUTPUT=False,
+                          **limits) as (plugin, token, msg):
+            print('plugin rate limit {MM_RATE_LIMIT}/s burst {MM_RATE_BURST}'.format(**plugin.config))
+            print('{:<32} {:>9} {:>10} {:>10}'.format('scenario', 'time (s)', 'API calls', 'LDAP'))
+            mm = plugin.init_mm(token)
+            for course in courses:
+                plugin.add_mapping(course)
+            run('full refresh (cold)', mattermost, directory, lambda: list(plugin.sync(courses, mm)))
+            run('full refresh (no change)', mattermost, directory, lambda: list(plugin.sync(courses, mm, True)))
+            run('incremental refresh (no change)', mattermost, directory, lambda: list(plugin.sync(courses, mm)))
+            directory.churn(args.churn)
+            run('incremental refresh ({:.0%} churn)'.format(args.churn), mattermost, directory,
+                lambda: list(plugin.sync(courses, mm)))
+            plugin.change_feed = change_feed(plugin, directory)
+            # the first poll only sets the watermark
+            plugin.watch_changes(mm)
+            directory.churn(args.churn, args.changed)
+            run('change-driven sync ({:.0%} changed)'.format(args.changed), mattermost, directory,
+                lambda: wait(plugin.watch_changes(mm)))
+            # the commands queue these as jobs, time the work itself
+            run('team list', mattermost, directory, lambda: list(plugin.team_list(mm)))
+            usernames = sorted(directory.people)[:args.bulk_users]
+            run('bulk add {} users'.format(args.bulk_users), mattermost, directory,
+                lambda: list(plugin.users_add(mm, 'bench-team-00000', usernames, 'user')))
+            run('bulk deactivate {} users'.format(args.bulk_users), mattermost, directory,
+                lambda: list(plugin.users_change(None, msg, mm, usernames, None, 'deactivate', plugin.deactivate_user)))
+    finally:
+        mattermost.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Micro-benchmark of the team membership diff over synthetic rosters
+
+Usage: python bench/roster_diff.py [--sizes 10000 100000] [--repeat 3]
+
+It needs the same environment as the plugin, run it from the plugin directory.
+"""
+import argparse
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mattermost import RosterDiff  # noqa: E402
+
+# the list scan is quadratic, don't wait for it on the large rosters
+LIST_SCAN_LIMIT = 20000
+
+
+def make_rosters(size, churn=0.05):
+    """Build a roster of size users and a team whose members differ by churn from it"""
+    users = [{'id': uuid.uuid4().hex, 'username': 'student{}'.format(i)} for i in range(size)]
+    changed = int(size * churn)
+    members = [{'user_id': u['id'], 'roles': 'team_user', 'delete_at': 0} for u in users[changed:]]
+    members.extend({'user_id': uuid.uuid4().hex, 'roles': 'team_user', 'delete_at': 0} for _ in range(changed))
+    return users, members
+
+
+def list_scan(users, members):
+    """The membership check used before RosterDiff"""
+    member_ids = [m['user_id'] for m in members]
+    return [u for u in users if u['id'] not in member_ids]
+
+
+def roster_diff(users, members):
+    diff = RosterDiff(RosterDiff.from_users(users), RosterDiff.from_members(members))
+    return [u for u in users if u['id'] in diff.to_add]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:>8} {:>14} {:>14}'.format('members', 'list scan (s)', 'diff (s)'))
+    for size in args.sizes:
+        users, members = make_rosters(size)
+        diff_time = min(timeit.repeat(lambda: roster_diff(users, members), number=1, repeat=args.repeat))
+        if size <= LIST_SCAN_LIMIT:
+            assert len(list_scan(users, members)) == len(roster_diff(users, members))
+            scan_time = '{:14.4f}'.format(min(timeit.repeat(lambda: list_scan(users, members), number=1, repeat=1)))
+        else:
+            scan_time = '{:>14}'.format('skipped')
+        print('{:>8} {} {:14.4f}'.format(size, scan_time, diff_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Check that the scheduled sync keeps moving past broken courses and interrupted runs, against the local Mattermost and
+LDAP stand-ins
+
+Usage: python bench/scheduler.py [--courses 10] [--students 500]
+
+It needs the same environment as the plugin, run it from the plugin directory. It exits with 1 when a check fails.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standin import FakeDirectory, FakeMattermost, bench_plugin  # noqa: E402
+
+BROKEN_SECTION = ('BROKEN', '100', '001', '2026W')
+BROKEN_COURSE = '_'.join(BROKEN_SECTION)
+
+
+class BrokenDirectory(FakeDirectory):
+    """A directory failing with an unexpected error on the broken section, e.g. an unparseable course spec"""
+
+    def members(self, section):
+        if tuple(section) == BROKEN_SECTION:
+            raise RuntimeError('Broken course {}'.format(section))
+        return super(BrokenDirectory, self).members(section)
+
+
+def check(name, ok):
+    print('{:<60} {}'.format(name, 'ok' if ok else 'FAILED'))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--courses', type=int, default=10, help='number of course mappings')
+    parser.add_argument('--students', type=int, default=500, help='number of students in the directory')
+    parser.add_argument('--workers', type=int, default=1, help='SYNC_WORKERS of the plugin')
+    args = parser.parse_args()
+
+    mattermost = FakeMattermost()
+    mattermost.start()
+    directory = BrokenDirectory(args.courses, args.students)
+    # the last course is mapped later, so a tick after the others are synced has a course to sync
+    courses = directory.course_specs[:-1]
+    late_course = directory.course_specs[-1]
+    results = []
+    try:
+        # one shard, so a tick syncs all the courses due
+        with bench_plugin(mattermost, directory, SYNC_SHARDS=1, SYNC_WORKERS=args.workers,
+                          SYNC_ATTACH_OUTPUT=False) as (plugin, token, msg):
+            plugin.config['MM_ENCRYPTED_ACCESS_TOKEN'] = token
+            plugin.add_mapping(BROKEN_COURSE)
+            for course in courses:
+                plugin.add_mapping(course)
+
+            plugin.refresh()
+            state = plugin.get_checkpoint('refresh')
+            results.append(check('a broken course does not stop the tick', state['finished']))
+            results.append(check('the other courses are synced', all(
+                plugin.get_sync_history(c)[-1]['status'] == 'done' for c in courses)))
+            results.append(check('the broken course is marked failed', state['steps'].get(BROKEN_COURSE) == 'failed'))
+
+            # a run interrupted by a restart, with a course removed from the mapping since
+            plugin.start_checkpoint('refresh', [BROKEN_COURSE] + courses)
+            plugin.remove_mapping(BROKEN_COURSE)
+            plugin.refresh()
+            state = plugin.get_checkpoint('refresh')
+            results.append(check('an interrupted run is resumed and finished', state['finished']))
+            results.append(check('a removed course is left out of the resumed run',
+                                 BROKEN_COURSE not in state['steps']))
+
+            # a run which failed to finish on every resume is given up
+            state = plugin.start_checkpoint('refresh', courses)[0]
+            plugin.update_checkpoint('refresh', courses[0], 'ldap')
+            for _ in range(plugin.config['SYNC_MAX_RESUMES']):
+                plugin.start_checkpoint('refresh', courses)
+            plugin.add_mapping(late_course)
+            plugin.refresh()
+            new_state = plugin.get_checkpoint('refresh')
+            results.append(check('a run is given up after SYNC_MAX_RESUMES resumes',
+                                 new_state['run_id'] != state['run_id'] and new_state['courses'] == [late_course]))
+    finally:
+        mattermost.stop()
+
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
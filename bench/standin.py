@@ -0,0 +1,447 @@
+"""
+Local stand-ins for Mattermost and LDAP, so the plugin can be benchmarked without network access
+
+* FakeMattermost - in-process Mattermost REST server covering the API calls the plugin makes
+* FakeDirectory - in-memory LDAP directory of course sections and students, its course groups can also be served by
+  an ldap3 mock connection for the LDAP change watcher
+* FakeSync - the mattermostsync.Sync interface, talking to FakeMattermost through mattermostdriver and reading the
+  rosters from FakeDirectory
+* bench_plugin - boots errbot's test bot with the plugin configured against the stand-ins
+"""
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+
+import ldap3
+from cryptography.fernet import Fernet
+from mattermostdriver import Driver
+from mattermostdriver.exceptions import ResourceNotFound
+from mattermostsync import CourseNotFound, parse_course
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_USER = '@bench'
+
+
+def new_id():
+    """Mattermost style id of 26 lower case alphanumerics"""
+    return uuid.uuid4().hex[:26]
+
+
+class FakeMattermost(object):
+    """
+    In-process Mattermost REST server, every request sleeps for latency seconds. When rate_limit is set, the requests
+    are limited like the rate limiter of Mattermost: a bucket of burst requests refilled at rate_limit per second, the
+    requests over it are rejected with 429, and the X-Ratelimit-* headers are sent the same way.
+    """
+
+    def __init__(self, latency=0.0, rate_limit=0, burst=100):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.bucket = (float(burst), time.monotonic())
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.users = {}
+        self.usernames = {}
+        self.teams = {}
+        self.team_names = {}
+        self.members = {}
+        self.bot = self.add_user('bench-bot')
+        self.routes = [
+            ('GET', r'/users/me', self.get_me),
+            ('POST', r'/users/usernames', self.get_users_by_usernames),
+            ('GET', r'/users/username/(?P<username>[^/]+)', self.get_user_by_username),
+            ('POST', r'/users', self.create_user),
+            ('GET', r'/users/(?P<user_id>\w+)/teams', self.get_user_teams),
+            ('PUT', r'/users/(?P<user_id>\w+)/active', self.update_user_active),
+            ('PUT', r'/users/(?P<user_id>\w+)/auth', self.update_user_auth),
+            ('PUT', r'/users/(?P<user_id>\w+)/patch', self.patch_user),
+            ('GET', r'/teams', self.get_teams),
+            ('POST', r'/teams', self.create_team),
+            ('GET', r'/teams/name/(?P<name>[^/]+)', self.get_team_by_name),
+            ('GET', r'/teams/(?P<team_id>\w+)/stats', self.get_team_stats),
+            ('GET', r'/teams/(?P<team_id>\w+)/members', self.get_team_members),
+            ('POST', r'/teams/(?P<team_id>\w+)/members', self.add_team_member),
+            ('POST', r'/teams/(?P<team_id>\w+)/members/batch', self.add_team_members),
+            ('POST', r'/teams/(?P<team_id>\w+)/members/ids', self.get_team_members_by_ids),
+            ('GET', r'/teams/(?P<team_id>\w+)/members/(?P<user_id>\w+)', self.get_team_member),
+            ('DELETE', r'/teams/(?P<team_id>\w+)/members/(?P<user_id>\w+)', self.remove_team_member),
+            ('PUT', r'/teams/(?P<team_id>\w+)/members/(?P<user_id>\w+)/roles', self.update_team_member_roles),
+        ]
+        self.routes = [(m, re.compile('^/api/v4' + p + '$'), h) for m, p, h in self.routes]
+        self.server = None
+
+    # seeding
+
+    def add_user(self, username):
+        user = {'id': new_id(), 'username': username, 'email': '{}@example.com'.format(username),
+                'first_name': username, 'last_name': 'Bench', 'nickname': '', 'auth_service': 'ldap',
+                'auth_data': username, 'delete_at': 0}
+        self.users[user['id']] = user
+        self.usernames[username] = user['id']
+        return user
+
+    def add_team(self, name, display_name=None):
+        team = {'id': new_id(), 'name': name, 'display_name': display_name or name, 'type': 'I', 'delete_at': 0}
+        self.teams[team['id']] = team
+        self.team_names[name] = team['id']
+        self.members[team['id']] = {}
+        return team
+
+    def add_member(self, team_id, user_id, roles='team_user'):
+        member = self.members[team_id].get(user_id)
+        if member is None or member['delete_at']:
+            member = {'team_id': team_id, 'user_id': user_id, 'roles': roles, 'delete_at': 0,
+                      'scheme_user': True, 'scheme_admin': 'team_admin' in roles}
+            self.members[team_id][user_id] = member
+        return member
+
+    # server
+
+    def start(self):
+        handler = type('FakeMattermostHandler', (FakeMattermostHandler,), {'fake': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='fake-mattermost', daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def throttle(self):
+        """Take the request from the bucket, returns the rate limit headers and if it is allowed"""
+        if not self.rate_limit:
+            return {}, True
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.burst, self.bucket[0] + (now - self.bucket[1]) * self.rate_limit)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.bucket = (tokens, now)
+        # the reset is the time until the bucket is full again, rounded up to seconds like Mattermost does
+        headers = {'X-Ratelimit-Limit': str(self.burst),
+                   'X-Ratelimit-Remaining': str(int(tokens)),
+                   'X-Ratelimit-Reset': str(math.ceil((self.burst - tokens) / self.rate_limit))}
+        if not allowed:
+            headers['Retry-After'] = str(math.ceil((1 - tokens) / self.rate_limit))
+        return headers, allowed
+
+    def dispatch(self, method, path, query, body):
+        time.sleep(self.latency)
+        headers, allowed = self.throttle()
+        if not allowed:
+            self.calls[('throttled', path)] += 1
+            return 429, {'message': 'Too many requests'}, headers
+        for m, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if m == method and match:
+                self.calls[(method, pattern.pattern)] += 1
+                with self.lock:
+                    return handler(query=query, body=body, **match.groupdict()) + (headers,)
+        return 404, {'message': 'No route for {} {}'.format(method, path)}, headers
+
+    # endpoints, each returns the status code and the JSON body
+
+    def get_me(self, **kwargs):
+        return 200, self.bot
+
+    def get_users_by_usernames(self, body, **kwargs):
+        return 200, [self.users[self.usernames[u]] for u in body if u in self.usernames]
+
+    def get_user_by_username(self, username, **kwargs):
+        if username not in self.usernames:
+            return 404, {'message': 'User not found'}
+        return 200, self.users[self.usernames[username]]
+
+    def create_user(self, body, **kwargs):
+        if body['username'] in self.usernames:
+            return 400, {'message': 'An account with that username already exists'}
+        return 201, self.add_user(body['username'])
+
+    def get_user_teams(self, user_id, **kwargs):
+        return 200, [self.teams[t] for t, m in self.members.items() if user_id in m and not m[user_id]['delete_at']]
+
+    def update_user_active(self, user_id, body, **kwargs):
+        self.users[user_id]['delete_at'] = 0 if body['active'] else int(time.time() * 1000)
+        return 200, {'status': 'OK'}
+
+    def update_user_auth(self, user_id, body, **kwargs):
+        self.users[user_id].update(auth_service=body['auth_service'], auth_data=body.get('auth_data', ''))
+        return 200, self.users[user_id]
+
+    def patch_user(self, user_id, body, **kwargs):
+        self.users[user_id].update(body)
+        return 200, self.users[user_id]
+
+    def get_teams(self, query, **kwargs):
+        page, per_page = int(query.get('page', 0)), int(query.get('per_page', 60))
+        teams = sorted(self.teams.values(), key=lambda t: t['name'])
+        page_teams = teams[page * per_page:(page + 1) * per_page]
+        if query.get('include_total_count') in ('True', 'true'):
+            return 200, {'teams': page_teams, 'total_count': len(teams)}
+        return 200, page_teams
+
+    def create_team(self, body, **kwargs):
+        if body['name'] in self.team_names:
+            return 400, {'message': 'A team with that name already exists'}
+        return 201, self.add_team(body['name'], body.get('display_name'))
+
+    def get_team_by_name(self, name, **kwargs):
+        if name not in self.team_names:
+            return 404, {'message': 'Team not found'}
+        return 200, self.teams[self.team_names[name]]
+
+    def get_team_stats(self, team_id, **kwargs):
+        count = sum(1 for m in self.members[team_id].values() if not m['delete_at'])
+        return 200, {'team_id': team_id, 'total_member_count': count, 'active_member_count': count}
+
+    def get_team_members(self, team_id, query, **kwargs):
+        page, per_page = int(query.get('page', 0)), int(query.get('per_page', 60))
+        members = [m for m in self.members[team_id].values() if not m['delete_at']]
+        return 200, members[page * per_page:(page + 1) * per_page]
+
+    def add_team_member(self, team_id, body, **kwargs):
+        return 201, self.add_member(team_id, body['user_id'])
+
+    def add_team_members(self, team_id, body, **kwargs):
+        return 201, [self.add_member(team_id, m['user_id'], m.get('roles') or 'team_user') for m in body]
+
+    def get_team_members_by_ids(self, team_id, body, **kwargs):
+        return 200, [self.members[team_id][u] for u in body if u in self.members[team_id]]
+
+    def get_team_member(self, team_id, user_id, **kwargs):
+        member = self.members.get(team_id, {}).get(user_id)
+        if member is None or member['delete_at']:
+            return 404, {'message': 'Team member not found'}
+        return 200, member
+
+    def remove_team_member(self, team_id, user_id, **kwargs):
+        self.members[team_id][user_id]['delete_at'] = int(time.time() * 1000)
+        return 200, {'status': 'OK'}
+
+    def update_team_member_roles(self, team_id, user_id, body, **kwargs):
+        self.members[team_id][user_id]['roles'] = body['roles']
+        return 200, {'status': 'OK'}
+
+
+class FakeMattermostHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fake = None
+
+    def handle_request(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        body = json.loads(raw) if raw else None
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        status, data, headers = self.fake.dispatch(self.command, url.path, query, body)
+        if status >= 400:
+            data = dict(data, status_code=status)
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeDirectory(object):
+    """
+    In-memory LDAP directory with courses courses, each spread over one or two sections, taken by students
+    students who take course_load courses each. Every lookup sleeps for latency seconds.
+    """
+
+    LDAP_BASE = 'ou=groups,dc=bench'
+
+    def __init__(self, courses, students, course_load=5, cross_listed=0.2, latency=0.0, seed=0):
+        self.latency = latency
+        self.queries = 0
+        self.ldap = None
+        self.clock = datetime(2026, 9, 1)
+        self.random = random.Random(seed)
+        self.people = dict((u, {'username': u, 'email': '{}@example.com'.format(u), 'first_name': u,
+                                'last_name': 'Student'})
+                           for u in ('s{:06d}'.format(i) for i in range(students)))
+        self.course_specs = []
+        self.sections = {}
+        for i in range(courses):
+            if self.random.random() < cross_listed:
+                spec = 'BNCH_{0:03d}_001_2026W+BNCH_{0:03d}_002_2026W=BNCH-{0:03d}'.format(i)
+            else:
+                spec = 'BNCH_{:03d}_001_2026W'.format(i)
+            self.course_specs.append(spec)
+            for section in parse_course(spec)[0]:
+                self.sections[tuple(section)] = set()
+        keys = list(self.sections)
+        for username in self.people:
+            for section in self.random.sample(keys, min(course_load, len(keys))):
+                self.sections[section].add(username)
+
+    def churn(self, fraction, share=1.0):
+        """Move fraction of the students of share of the sections to another one of those sections"""
+        keys = list(self.sections)
+        if share < 1:
+            keys = self.random.sample(keys, max(int(len(keys) * share), 1))
+        for key in keys:
+            moved = self.random.sample(sorted(self.sections[key]), int(len(self.sections[key]) * fraction))
+            for username in moved:
+                self.sections[key].discard(username)
+                self.sections[self.random.choice(keys)].add(username)
+        if self.ldap is not None:
+            self.clock += timedelta(seconds=1)
+            for key in keys:
+                self.ldap.modify(self.group_dn(key), {'modifyTimestamp': [(ldap3.MODIFY_REPLACE, [self.timestamp()])]})
+
+    def group_dn(self, section):
+        return 'cn={},{}'.format('_'.join(section), self.LDAP_BASE)
+
+    def timestamp(self):
+        return self.clock.strftime('%Y%m%d%H%M%SZ')
+
+    def ldap_connection(self):
+        """ldap3 mock connection with a group per section, churn updates the modifyTimestamp of the groups"""
+        if self.ldap is None:
+            connection = ldap3.Connection(ldap3.Server('bench'), user='cn=bench,dc=bench', password='bench',
+                                          client_strategy=ldap3.MOCK_SYNC)
+            connection.strategy.add_entry('cn=bench,dc=bench', {'userPassword': 'bench', 'sn': 'bench'})
+            connection.bind()
+            for section in self.sections:
+                connection.strategy.add_entry(self.group_dn(section), {
+                    'cn': '_'.join(section), 'objectClass': 'groupOfNames', 'modifyTimestamp': self.timestamp()})
+            self.ldap = connection
+        return self.ldap
+
+    def members(self, section):
+        time.sleep(self.latency)
+        self.queries += 1
+        if tuple(section) not in self.sections:
+            raise CourseNotFound('Course {} is not found in LDAP'.format(section))
+        return [self.people[u] for u in sorted(self.sections[tuple(section)])]
+
+    def user(self, username):
+        time.sleep(self.latency)
+        self.queries += 1
+        return [self.people[username]] if username in self.people else []
+
+
+class FakeSync(object):
+    """The mattermostsync.Sync interface backed by FakeMattermost and FakeDirectory"""
+    directory = None
+
+    def __init__(self, config):
+        self.config = config
+        self.driver = Driver({
+            'url': re.sub(r'^\w+://', '', config['url']),
+            'port': config['port'],
+            'scheme': config['scheme'],
+            'token': config['token'],
+            'debug': config['debug'],
+        })
+
+    def get_member_from_ldap(self, base, *section):
+        return self.directory.members(section)
+
+    def get_users_from_ldap(self, username):
+        return self.directory.user(username)
+
+    def create_users(self, users):
+        existing = self.driver.users.get_users_by_usernames([u['username'] for u in users]) if users else []
+        found = set(u['username'] for u in existing)
+        failed = []
+        for u in users:
+            if u['username'] in found:
+                continue
+            try:
+                existing.append(self.driver.users.create_user(dict(u, auth_service='ldap', auth_data=u['username'])))
+            except Exception:
+                failed.append(u)
+        return existing, failed
+
+    def get_team_by_name(self, name):
+        try:
+            return self.driver.teams.get_team_by_name(name)
+        except ResourceNotFound:
+            return None
+
+    def create_team(self, name, display_name=None, type='I'):
+        return self.driver.teams.create_team({'name': name, 'display_name': display_name or name, 'type': type})
+
+    def get_team_members(self, team_id, params=None):
+        return self.driver.teams.get_team_members(team_id, params)
+
+    def add_users_to_team(self, users, team_id, roles='team_user'):
+        return self.driver.teams.add_multiple_users_to_team(
+            team_id, [{'team_id': team_id, 'user_id': u['id'], 'roles': roles} for u in users])
+
+
+def change_feed(plugin, directory):
+    """The LdapChangeFeed of the plugin reading the course groups of the directory"""
+    feed = sys.modules[type(plugin).__module__].LdapChangeFeed
+    return feed(directory.ldap_connection(), directory.LDAP_BASE, '(objectClass=groupOfNames)')
+
+
+@contextmanager
+def bench_plugin(mattermost, directory, **config):
+    """
+    Boot errbot's test bot with the plugin activated against the stand-ins, yields the plugin object, the encrypted
+    access token and a message from a plugin admin to call the commands with
+    """
+    from errbot.backends.test import TestBot
+
+    key = Fernet.generate_key()
+    os.environ['ENCRYPTION_KEY'] = key.decode('utf-8')
+    fernet = Fernet(key)
+    token = fernet.encrypt(b'bench-token').decode('utf-8')
+
+    bot = TestBot(extra_plugin_dir=ROOT, loglevel=logging.ERROR, extra_config={'BOT_ADMINS': (BENCH_USER,)})
+    bot.start()
+    # the driver logs every expected 404, e.g. looking up a team before creating it
+    logging.getLogger('mattermostdriver.websocket').setLevel(logging.CRITICAL)
+    try:
+        manager = bot.bot.plugin_manager
+        plugin = manager.get_plugin_obj_by_name('Mattermost')
+        # the LDAP side of Sync is replaced by the directory
+        FakeSync.directory = directory
+        sys.modules[type(plugin).__module__].Sync = FakeSync
+        settings = dict(plugin.get_configuration_template(), **{
+            'MM_URL': '127.0.0.1',
+            'MM_PORT': mattermost.server.server_address[1],
+            'MM_SCHEME': 'http',
+            'MM_CHANNEL': 'mattermost',
+            'MM_ENCRYPTED_ACCESS_TOKEN': None,
+            'LDAP_BIND_ENCRYPTED_PASSWORD': fernet.encrypt(b'bench-password').decode('utf-8'),
+            'ADMINS': (BENCH_USER,),
+        })
+        settings.update(config)
+        manager.set_plugin_configuration('Mattermost', settings)
+        if plugin.is_activated:
+            manager.deactivate_plugin('Mattermost')
+        manager.activate_plugin('Mattermost')
+        plugin = manager.get_plugin_obj_by_name('Mattermost')
+        message = SimpleNamespace(frm=SimpleNamespace(person=BENCH_USER), is_group=False)
+        plugin.mm_token_set(message, token)
+        yield plugin, token, message
+    finally:
+        bot.stop()
@@ -1,10 +1,725 @@
+import hashlib
+import math
 import os
-from mattermostdriver.exceptions import ResourceNotFound, NoAccessTokenProvided
-from requests import HTTPError
-from cryptography.fernet import Fernet, InvalidToken
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import chain, count
 
 from errbot import BotPlugin, botcmd, arg_botcmd
-from mattermostsync import Sync, CourseNotFound, parse_course
+
+# the Mattermost, LDAP and crypto libraries take a while to import, import_clients imports them on first use so the
+# plugin loads fast. Don't use these names before it is called
+Sync = CourseNotFound = parse_course = None
+ResourceNotFound = NoAccessTokenProvided = HTTPError = None
+Fernet = InvalidToken = None
+clients_lock = threading.Lock()
+
+# maximum page size allowed by Mattermost API and a safe guard for the number of pages
+MAX_PAGE_SIZE = 200
+MAX_PAGES = 1000
+# latency assumed for a Mattermost API call when there is none observed yet
+DEFAULT_API_SECONDS = 0.1
+# message size used when the bot has no MESSAGE_SIZE_LIMIT, and the number of problems listed in a sync summary
+MAX_MESSAGE_SIZE = 10000
+MAX_REPORTED_PROBLEMS = 20
+# number of the last output lines kept for a job
+JOB_OUTPUT_LINES = 20
+# fields of a sync history record, kept as a tuple in this order
+SYNC_HISTORY_FIELDS = ('time', 'seconds', 'ldap', 'created', 'added', 'removed', 'failed', 'status')
+
+
+def import_clients():
+    """
+    Import the Mattermost, LDAP and crypto libraries into the module, once. Names set already, e.g. a stand-in of Sync,
+    are kept. Returns the seconds the imports took, 0 when they are imported already
+    """
+    global Sync, CourseNotFound, parse_course, ResourceNotFound, NoAccessTokenProvided, HTTPError, Fernet, InvalidToken
+    if HTTPError is not None:
+        return 0
+    with clients_lock:
+        if HTTPError is not None:
+            return 0
+        start = time.monotonic()
+        import cryptography.fernet
+        import mattermostdriver.exceptions
+        import mattermostsync
+        import requests
+
+        Fernet = Fernet or cryptography.fernet.Fernet
+        InvalidToken = InvalidToken or cryptography.fernet.InvalidToken
+        Sync = Sync or mattermostsync.Sync
+        CourseNotFound = CourseNotFound or mattermostsync.CourseNotFound
+        parse_course = parse_course or mattermostsync.parse_course
+        ResourceNotFound = ResourceNotFound or mattermostdriver.exceptions.ResourceNotFound
+        NoAccessTokenProvided = NoAccessTokenProvided or mattermostdriver.exceptions.NoAccessTokenProvided
+        # set last, the other names are ready once it is set
+        HTTPError = requests.HTTPError
+        return time.monotonic() - start
+
+
+def member_key(member):
+    """Identify a LDAP member or a Mattermost user by its lower cased username"""
+    return (member.get('username') or repr(member)).lower()
+
+
+def split_usernames(names):
+    """Lower cased usernames from command arguments separated by spaces, commas or new lines, without duplicates"""
+    return list(dict.fromkeys(u.strip().lower() for n in names for u in re.split(r'[\s,]+', n) if u.strip()))
+
+
+def roster_hash(members):
+    """Hash a LDAP roster, independent of the order of the members"""
+    return hashlib.sha1('\n'.join(sorted(member_key(m) for m in members)).encode('utf-8')).hexdigest()
+
+
+def paginate(fetch, total=None, workers=1, per_page=MAX_PAGE_SIZE):
+    """
+    Fetch all the pages of a paged Mattermost API call, a generator of the pages in order
+
+    fetch(page, per_page) returns the items on a page. When the first page is full and total is given, total() returns
+    the number of items and the rest of the pages are fetched concurrently by the workers. Otherwise the pages are
+    fetched one after another until a short page.
+    """
+    items = fetch(0, per_page)
+    yield items
+    page = 1
+    if len(items) == per_page and total is not None and workers > 1:
+        pages = -(-total() // per_page)
+        with ThreadPoolExecutor(workers, thread_name_prefix='mm-page') as executor:
+            for items in executor.map(lambda p: fetch(p, per_page), range(1, pages)):
+                yield items
+        page = max(pages, 1)
+    # the total may be outdated by now, carry on until a short page
+    while len(items) == per_page and page < MAX_PAGES:
+        items = fetch(page, per_page)
+        if items:
+            yield items
+        page += 1
+
+
+class Metrics(object):
+    """Thread safe counters and timers, rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        # count, sum and max of the observed durations
+        self._timers = defaultdict(lambda: [0, 0.0, 0.0])
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, seconds, **labels):
+        with self._lock:
+            timer = self._timers[(name, tuple(sorted(labels.items())))]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def counters(self, name):
+        """Values of the counter by labels, labels are returned as a tuple of items"""
+        with self._lock:
+            return dict((labels, v) for (n, labels), v in self._counters.items() if n == name)
+
+    def timers(self, name):
+        """Count, sum and max of the timer by labels, labels are returned as a tuple of items"""
+        with self._lock:
+            return dict((labels, tuple(v)) for (n, labels), v in self._timers.items() if n == name)
+
+    def total(self, name):
+        return sum(self.counters(name).values())
+
+    def exposition(self):
+        def series(name, labels, value):
+            label_str = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in labels)
+            return '{}{} {}'.format(name, '{' + label_str + '}' if label_str else '', value)
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timers = sorted((k, tuple(v)) for k, v in self._timers.items())
+        lines = []
+        for name in sorted(set(n for (n, _), _ in counters)):
+            lines.append('# TYPE {} counter'.format(name))
+            lines.extend(series(n, labels, v) for (n, labels), v in counters if n == name)
+        for name in sorted(set(n for (n, _), _ in timers)):
+            lines.append('# TYPE {} summary'.format(name))
+            for (n, labels), (calls, total, maximum) in timers:
+                if n == name:
+                    lines.append(series(name + '_count', labels, calls))
+                    lines.append(series(name + '_sum', labels, total))
+                    lines.append(series(name + '_max', labels, maximum))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the metrics of the server for scraping"""
+
+    def do_GET(self):
+        body = self.server.metrics.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket limiting the request rate, rate tokens are added per second up to capacity. A rate of 0
+    disables the limit. The rate and capacity given are a starting point, the bucket sizes itself from the
+    X-Ratelimit-* headers of the server.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.configured_rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # the range the rate of the server is known to be in, from the headers seen so far
+        self.rate_bounds = (0, float('inf'))
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Take a token, block until one is available"""
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def update(self, headers):
+        """
+        Align the bucket with the X-Ratelimit-* headers from the server. The limit is the burst of the server and the
+        reset is the seconds until its bucket is full again, so the requests missing from it over the reset give its
+        rate. The reset is rounded up to whole seconds and remaining down, so each response only bounds the rate, the
+        bounds narrow down as the responses come in
+        """
+        if not self.rate:
+            return
+        limit = headers.get('X-Ratelimit-Limit')
+        remaining = headers.get('X-Ratelimit-Remaining')
+        reset = headers.get('X-Ratelimit-Reset')
+        with self._lock:
+            self._refill(time.monotonic())
+            if limit:
+                limit = int(limit)
+                if limit != self.capacity:
+                    # the server is configured differently, start over
+                    self.capacity = limit
+                    self.rate_bounds = (0, float('inf'))
+                    self.rate = self.configured_rate
+            if remaining is None:
+                return
+            remaining = int(remaining)
+            self.tokens = min(self.tokens, remaining)
+            if not limit or not reset or int(reset) <= 0 or remaining >= limit:
+                return
+            reset = int(reset)
+            missing = limit - remaining
+            low = max((missing - 1) / reset, 0)
+            high = missing / (reset - 1) if reset > 1 else float('inf')
+            low, high = max(self.rate_bounds[0], low), min(self.rate_bounds[1], high)
+            if low > high:
+                # the server changed its rate, trust the latest response only
+                low, high = max((missing - 1) / reset, 0), missing / (reset - 1) if reset > 1 else float('inf')
+            self.rate_bounds = (low, high)
+            self.rate = min(max(self.configured_rate, low), high) or self.configured_rate
+
+
+class OutputAggregator(object):
+    """
+    Collect the output of a long running command. Lines are batched into messages under the size limit, the messages
+    of each course are collapsed into a progress summary sent every interval seconds, and the whole output is kept to
+    be sent as a file
+    """
+
+    def __init__(self, max_size=MAX_MESSAGE_SIZE, interval=30, total=None, unit='courses'):
+        self.max_size = max_size
+        self.interval = interval
+        self.total = total
+        self.unit = unit
+        self.detail = []
+        self.pending = ''
+        self.courses = 0
+        self.problems = []
+        self.started = self.reported = time.monotonic()
+
+    def add(self, *lines):
+        """Add the lines to the output, returns the messages filled up to the size limit"""
+        messages = []
+        for line in lines:
+            line = str(line)
+            self.detail.append(line)
+            if self.pending and len(self.pending) + 1 + len(line) > self.max_size:
+                messages.append(self.pending)
+                self.pending = ''
+            # a line longer than a message is split
+            while len(line) > self.max_size:
+                messages.append(line[:self.max_size])
+                line = line[self.max_size:]
+            self.pending = self.pending + '\n' + line if self.pending else line
+        return messages
+
+    def flush(self):
+        """Messages with the rest of the lines"""
+        messages = [self.pending] if self.pending else []
+        self.pending = ''
+        return messages
+
+    def course(self, course, msgs):
+        """Record the output of a finished course, or user, returns the progress summary when one is due"""
+        msgs = [str(m) for m in msgs]
+        self.detail.extend(msgs)
+        self.courses += 1
+        self.problems.extend(m for m in msgs if m.startswith(('Warning', 'Failed')))
+        if time.monotonic() - self.reported < self.interval:
+            return []
+        self.reported = time.monotonic()
+        return [self.progress()]
+
+    def progress(self):
+        return '{} of {} {} done in {:.0f}s, {} warnings and errors so far.'.format(
+            self.courses, self.total if self.total is not None else '?', self.unit, time.monotonic() - self.started,
+            len(self.problems))
+
+    def summary(self):
+        """The final messages, the progress and the warnings and errors"""
+        lines = [self.progress()] + self.problems[:MAX_REPORTED_PROBLEMS]
+        if len(self.problems) > MAX_REPORTED_PROBLEMS:
+            lines.append('... and {} more.'.format(len(self.problems) - MAX_REPORTED_PROBLEMS))
+        # the summary is not part of the detail
+        aggregator = OutputAggregator(self.max_size)
+        return aggregator.add(*lines) + aggregator.flush()
+
+    def attachment(self):
+        """The whole output as a file object and its size"""
+        data = '\n'.join(self.detail).encode('utf-8')
+        return BytesIO(data), len(data)
+
+
+class Job(object):
+    """A command running in the background, or a scheduled sync"""
+
+    def __init__(self, job_id, name, owner):
+        self.id = job_id
+        self.name = name
+        self.owner = owner
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.output = deque(maxlen=JOB_OUTPUT_LINES)
+        self.cancelled = threading.Event()
+        # the courses the job synced, or failed to sync
+        self.synced = set()
+        self.future = None
+
+
+class JobQueue(object):
+    """
+    Run the long commands on a pool of workers. It also keeps track of the courses being synced by the jobs and the
+    scheduler, so that a course is not synced by two of them at the same time
+    """
+
+    def __init__(self, workers, history=50):
+        self.executor = ThreadPoolExecutor(max(workers, 1), thread_name_prefix='mm-job')
+        self.history = history
+        self.jobs = OrderedDict()
+        self.courses = {}
+        self.lock = threading.Lock()
+        self.ids = count(1)
+
+    def add(self, name, owner):
+        with self.lock:
+            job = Job(next(self.ids), name, owner)
+            self.jobs[job.id] = job
+            # forget the oldest finished jobs
+            finished = [j.id for j in self.jobs.values() if j.finished]
+            for job_id in finished[:max(len(finished) - self.history, 0)]:
+                del self.jobs[job_id]
+            return job
+
+    def submit(self, name, owner, func, send):
+        """Queue a job running func, a generator function taking the job. Its messages are passed to send"""
+        job = self.add(name, owner)
+        job.future = self.executor.submit(self.run, job, func, send)
+        return job
+
+    def run(self, job, func, send):
+        self.start(job)
+        try:
+            for msg in func(job):
+                job.output.append(str(msg))
+                send(msg)
+        except Exception as e:
+            job.output.append('Failed: {}'.format(e))
+            self.finish(job, 'failed')
+            send('Job {} failed: {}'.format(job.id, e))
+            return
+        self.finish(job)
+
+    def track(self, name, owner):
+        """Add a job for work running outside of the queue, it is finished by the caller"""
+        job = self.add(name, owner)
+        self.start(job)
+        return job
+
+    @staticmethod
+    def start(job):
+        job.status = 'running'
+        job.started = time.time()
+
+    @staticmethod
+    def finish(job, status=None):
+        job.status = status or ('cancelled' if job.cancelled.is_set() else 'done')
+        job.finished = time.time()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job):
+        """Cancel a queued job, a running one stops at the next course"""
+        job.cancelled.set()
+        if job.future is not None and job.future.cancel():
+            self.finish(job, 'cancelled')
+
+    def claim(self, courses, owner):
+        """Claim the courses for a sync, returns the ones which are not being synced by someone else"""
+        with self.lock:
+            claimed = [c for c in courses if c not in self.courses]
+            for c in claimed:
+                self.courses[c] = owner
+            return claimed
+
+    def owner(self, course):
+        with self.lock:
+            return self.courses.get(course)
+
+    def release(self, courses):
+        with self.lock:
+            for c in courses:
+                self.courses.pop(c, None)
+
+    def shutdown(self):
+        for job in self.list():
+            self.cancel(job)
+        self.executor.shutdown(wait=False)
+
+
+class LdapChangeFeed(object):
+    """
+    Find the LDAP entries changed since a watermark, with a search on a change attribute such as modifyTimestamp or
+    an USN like uSNChanged. The watermark is the largest value seen together with the entries seen at that value, so
+    an entry is reported once although the search is inclusive
+    """
+
+    def __init__(self, connection, base, search_filter='(objectClass=*)', attribute='modifyTimestamp',
+                 name_attribute='cn', page_size=MAX_PAGE_SIZE):
+        self.connection = connection
+        self.base = base
+        self.search_filter = search_filter
+        self.attribute = attribute
+        self.name_attribute = name_attribute
+        self.page_size = page_size
+
+    @staticmethod
+    def order(value):
+        # USNs are compared as numbers, timestamps in the generalized time format as strings
+        return (0, int(value), '') if value.isdigit() else (1, 0, value)
+
+    def search(self, since=None):
+        """(dn, name, change value) of the entries changed since the value, or of all the entries"""
+        search_filter = self.search_filter
+        if since is not None:
+            search_filter = '(&{}({}>={}))'.format(search_filter, self.attribute, since)
+        entries = self.connection.extend.standard.paged_search(
+            self.base, search_filter, attributes=[self.attribute, self.name_attribute], paged_size=self.page_size,
+            generator=True)
+        for entry in entries:
+            if entry.get('type') != 'searchResEntry':
+                continue
+            attributes = entry['raw_attributes']
+            if not attributes.get(self.attribute) or not attributes.get(self.name_attribute):
+                continue
+            yield (entry['dn'], attributes[self.name_attribute][0].decode('utf-8'),
+                   attributes[self.attribute][0].decode('utf-8'))
+
+    def poll(self, watermark=None):
+        """
+        Names of the entries changed since the watermark and the new watermark. Without a watermark nothing is
+        reported, the watermark is set to the latest change in the directory
+        """
+        since = watermark['value'] if watermark else None
+        seen = set(watermark['seen']) if watermark else set()
+        changed = [e for e in self.search(since) if e[0] not in seen or e[2] != since]
+        if not changed:
+            return [], watermark
+        latest = max((e[2] for e in changed), key=self.order)
+        seen = (seen if latest == since else set()) | set(e[0] for e in changed if e[2] == latest)
+        names = sorted(set(e[1] for e in changed)) if watermark is not None else []
+        return names, {'value': latest, 'seen': sorted(seen)}
+
+
+class LdapPool(object):
+    """
+    Up to size LDAP connections of a session, each used by one thread at a time. The connections are Sync objects,
+    the ones given are used first and the rest are made by factory when needed. A connection whose query raises
+    anything but the expected errors is dropped, a new one is made in its place next time
+    """
+
+    def __init__(self, factory, size, connections=(), expected=()):
+        self.factory = factory
+        self.size = max(size, len(connections), 1)
+        self.idle = list(connections)
+        self.opened = len(self.idle)
+        self.expected = tuple(expected)
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        with self.cond:
+            while not self.idle and self.opened >= self.size:
+                self.cond.wait()
+            conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                self.opened += 1
+        if conn is None:
+            try:
+                conn = self.factory()
+            except Exception:
+                with self.cond:
+                    self.opened -= 1
+                    self.cond.notify()
+                raise
+        broken = False
+        try:
+            yield conn
+        except Exception as e:
+            # e.g. the bind went stale after an idle timeout or a restart of the server
+            broken = not isinstance(e, self.expected)
+            raise
+        finally:
+            with self.cond:
+                if broken:
+                    self.opened -= 1
+                else:
+                    self.idle.append(conn)
+                self.cond.notify()
+
+
+class TTLCache(object):
+    """Thread safe cache whose entries expire after ttl seconds"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class LRUCache(object):
+    """Thread safe cache keeping the maxsize entries used most recently"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class UserIndex(object):
+    """
+    Mattermost users of a sync run by member key. Every person is looked up, or created, once in the run however many
+    courses they take, and the users found are kept in the LRU cache shared by the runs
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.users = {}
+        self.failed = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, members, lookup, create):
+        """
+        The users of the LDAP members and the members failed to be created, the same as Sync.create_users. lookup
+        gets the existing users of a list of usernames, create creates the members missing from Mattermost
+        """
+        members = list(dict((member_key(m), m) for m in members).values())
+        todo = []
+        waiting = set()
+        done = threading.Event()
+        with self.lock:
+            for m in members:
+                key = member_key(m)
+                if key in self.users or key in self.failed:
+                    continue
+                if key in self.pending:
+                    # another course of the run is resolving them
+                    waiting.add(self.pending[key])
+                    continue
+                user = self.cache.get(key) if self.cache is not None else None
+                if user is not None:
+                    self.users[key] = user
+                    continue
+                self.pending[key] = done
+                todo.append(m)
+
+        users = {}
+        resolved = False
+        try:
+            if todo:
+                users.update((member_key(u), u) for u in lookup([member_key(m) for m in todo]))
+            missing = [m for m in todo if member_key(m) not in users]
+            if missing:
+                created, _ = create(missing)
+                users.update((member_key(u), u) for u in created)
+            resolved = True
+        finally:
+            # when the lookup fails, the members are left for the next course to try
+            with self.lock:
+                for m in todo:
+                    key = member_key(m)
+                    self.pending.pop(key, None)
+                    if key in users:
+                        self.users[key] = users[key]
+                        if self.cache is not None:
+                            self.cache.set(key, users[key])
+                    elif resolved:
+                        self.failed[key] = m
+            done.set()
+
+        for event in waiting:
+            event.wait()
+        with self.lock:
+            return ([self.users[member_key(m)] for m in members if member_key(m) in self.users],
+                    [m for m in members if member_key(m) not in self.users])
+
+
+class RosterDiff(object):
+    """
+    Membership difference between the desired roster of a team and its current members
+
+    Both rosters are dicts of user id to team roles. The roles of a desired user can be None to keep whatever roles
+    the user has in the team.
+    """
+
+    def __init__(self, desired, current):
+        self.to_add = desired.keys() - current.keys()
+        self.to_remove = current.keys() - desired.keys()
+        self.to_change = set(
+            user_id for user_id in desired.keys() & current.keys()
+            if desired[user_id] is not None and set(desired[user_id].split()) != set(current[user_id].split())
+        )
+
+    def __bool__(self):
+        return bool(self.to_add or self.to_remove or self.to_change)
+
+    @staticmethod
+    def from_users(users, roles=None):
+        """Build a desired roster from Mattermost users"""
+        return dict((u['id'], roles) for u in users)
+
+    @staticmethod
+    def from_members(members):
+        """Build a current roster from Mattermost team members, the removed members are left out"""
+        return dict((m['user_id'], m.get('roles') or '') for m in members if not m.get('delete_at'))
 
 
 class Mattermost(BotPlugin):
@@ -18,9 +733,64 @@ class Mattermost(BotPlugin):
         'user': 'team_user',
         'admin': 'team_user team_admin'
     }
+    ROSTER_SNAPSHOT_KEY = 'roster_snapshot:{}'
+    # one storage entry per token and per course mapping, so changing one doesn't rewrite all of them
+    TOKEN_KEY = 'token:{}'
+    COURSE_MAPPING_KEY = 'course_mapping:{}'
+    # a sync run, and the last step of each of its courses under its own entry, written when the course is finished
+    SYNC_CHECKPOINT_KEY = 'sync_checkpoint:{}'
+    SYNC_CHECKPOINT_STEP_KEY = 'sync_checkpoint_step:{}:{}'
+    LDAP_WATERMARK_KEY = 'ldap_watermark'
+    # the courses changed in LDAP and not synced yet, with the time the change was seen
+    LDAP_PENDING_KEY = 'ldap_pending'
+    SYNC_HISTORY_KEY = 'sync_history:{}'
+    # the steps a course goes through during sync, the last ones mean the course is done for the run
+    SYNC_STEPS = ('ldap', 'team', 'users', 'members', 'remove', 'failed')
+    SYNC_DONE_STEPS = ('done', 'unchanged', 'not found')
+    SYNC_STORED_STEPS = SYNC_DONE_STEPS + ('failed',)
+    # ids and names in the API endpoints are replaced to keep the number of metric series down
+    ENDPOINT_PATTERNS = (
+        (re.compile(r'/[a-z0-9]{26}(?=/|$)'), '/{id}'),
+        (re.compile(r'/(name|username|email)/[^/]+'), r'/\1/{\1}'),
+    )
+    # in memory copies of the stored tokens and course mappings, the mappings hold the metadata of the courses
     tokens = {}
-    course_mappings = set()
-    fernet = None
+    course_mappings = {}
+    # the last SYNC_HISTORY_SIZE syncs of each course, the changed ones are stored at the end of a sync run
+    sync_history = {}
+    sync_history_changed = set()
+    # the steps of the courses being synced by the runs with a checkpoint, by checkpoint name
+    checkpoint_steps = {}
+    encryption_key = None
+    _fernet = None
+    # startup timing, the heavy imports are timed by load_clients
+    activate_seconds = None
+    # the LDAP connection of a Sync object is not thread safe, a session queries LDAP over a pool of them
+    ldap_lock = threading.Lock()
+    # one query per course section at a time, the other workers wait for its result
+    section_locks = defaultdict(threading.Lock)
+    section_locks_lock = threading.Lock()
+    # the plugin storage is written from the sync workers
+    storage_lock = threading.Lock()
+    # logged in Sync objects by encrypted token, so the commands don't login and bind LDAP every time
+    sessions = None
+    session_lock = threading.Lock()
+    # LDAP members by course section
+    ldap_cache = None
+    # Mattermost users by username, shared by the sync runs
+    user_cache = None
+    # scheduler state, the tick decides which shard of the course mappings is synced
+    refresh_lock = threading.Lock()
+    refresh_tick = 0
+    course_changed_at = {}
+    metrics = Metrics()
+    metrics_server = None
+    # shared by all the sessions, the server limits the requests from the bot as a whole
+    rate_limiter = TokenBucket(0, 0)
+    # background jobs of the commands
+    jobs = None
+    # changes of the LDAP groups, for the event driven sync
+    change_feed = None
 
     def activate(self):
         """
@@ -32,23 +802,24 @@ class Mattermost(BotPlugin):
             self.log.info('Mattermost is not configured. Forbid activation')
             return
 
+        start = time.monotonic()
         key = os.environ.get('ENCRYPTION_KEY')
         if not key:
             raise ValueError('Missing encryption key. Please set ENCRYPTION_KEY environment variable.')
 
-        # init Fernet with decrypt token
-        self.fernet = Fernet(key.encode('utf-8'))
+        # Fernet is made on first use, the clients are not imported at startup
+        self.encryption_key = key
+        self._fernet = None
+        self.sessions = TTLCache(self.config['MM_SESSION_TTL'])
+        self.ldap_cache = TTLCache(self.config['LDAP_CACHE_TTL'])
+        self.user_cache = LRUCache(self.config['USER_CACHE_SIZE'])
+        self.rate_limiter = TokenBucket(self.config['MM_RATE_LIMIT'], self.config['MM_RATE_BURST'])
+        self.jobs = JobQueue(self.config['JOB_WORKERS'], self.config['JOB_HISTORY'])
 
         # need to activate plugin before accessing storage
         super(Mattermost, self).activate()
 
-        if 'tokens' not in self:
-            self['tokens'] = {}
-        self.tokens = self['tokens']
-
-        if 'course_mappings' not in self:
-            self['course_mappings'] = set()
-        self.course_mappings = self['course_mappings']
+        self.load_storage()
 
         # add additional acls
         self.bot_config.ACCESS_CONTROLS.update({
@@ -56,6 +827,10 @@ class Mattermost(BotPlugin):
                 'allowrooms': ('#' + self.config['MM_CHANNEL'],),
                 'allowusers': self.config['ADMINS'] + self.bot_config.BOT_ADMINS
             },
+            'Mattermost:mm_sync_*': {  # only allow admins to run and can only be run in #mattermost and direct msg
+                'allowrooms': ('#' + self.config['MM_CHANNEL'],),
+                'allowusers': self.config['ADMINS'] + self.bot_config.BOT_ADMINS
+            },
             'Mattermost:mm_token_*': {'allowmuc': False},  # only allow direct msg
             'Mattermost:mm_scheduler_*': {  # only allow admins to run and can only be run in #mattermost and direct msg
                 'allowrooms': ('#' + self.config['MM_CHANNEL'],),
@@ -73,19 +848,71 @@ class Mattermost(BotPlugin):
                 'allowrooms': ('#' + self.config['MM_CHANNEL'],),
                 'allowusers': self.config['ADMINS'] + self.bot_config.BOT_ADMINS
             },
+            'Mattermost:mm_users_*': {  # only allow admins to run and can only be run in #mattermost and direct msg
+                'allowrooms': ('#' + self.config['MM_CHANNEL'],),
+                'allowusers': self.config['ADMINS'] + self.bot_config.BOT_ADMINS
+            },
+            'Mattermost:mm_stats': {  # only allow admins to run and can only be run in #mattermost and direct msg
+                'allowrooms': ('#' + self.config['MM_CHANNEL'],),
+                'allowusers': self.config['ADMINS'] + self.bot_config.BOT_ADMINS
+            },
+            'Mattermost:mm_cache_*': {  # only allow admins to run and can only be run in #mattermost and direct msg
+                'allowrooms': ('#' + self.config['MM_CHANNEL'],),
+                'allowusers': self.config['ADMINS'] + self.bot_config.BOT_ADMINS
+            },
+            'Mattermost:mm_job_*': {  # only allow admins to run and can only be run in #mattermost and direct msg
+                'allowrooms': ('#' + self.config['MM_CHANNEL'],),
+                'allowusers': self.config['ADMINS'] + self.bot_config.BOT_ADMINS
+            },
         })
 
+        # start metrics endpoint
+        if self.config['METRICS_PORT']:
+            self.metrics_server = ThreadingHTTPServer(('127.0.0.1', self.config['METRICS_PORT']), MetricsHandler)
+            self.metrics_server.metrics = self.metrics
+            threading.Thread(target=self.metrics_server.serve_forever, name='mm-metrics', daemon=True).start()
+            self.log.info('Mattermost metrics are served on port {}'.format(self.config['METRICS_PORT']))
+
         # start scheduler
         if self.config['MM_ENCRYPTED_ACCESS_TOKEN']:
-            self.start_poller(self.config['SYNC_FREQUENCY'], self.refresh)
+            self.start_poller(self.refresh_interval(), self.refresh)
+            if self.config['LDAP_WATCH_INTERVAL']:
+                self.start_poller(self.config['LDAP_WATCH_INTERVAL'], self.watch_changes)
             self.log.info('Mattermost auto sync scheduler started')
 
+        self.activate_seconds = time.monotonic() - start
+        self.metrics.observe('activate_seconds', self.activate_seconds)
+        self.log.info('Mattermost plugin activated in {:.0f}ms'.format(self.activate_seconds * 1000))
+
+    @property
+    def fernet(self):
+        """Fernet of ENCRYPTION_KEY to decrypt the tokens and the LDAP password with, made on first use"""
+        if self._fernet is None:
+            self.load_clients()
+            self._fernet = Fernet(self.encryption_key.encode('utf-8'))
+        return self._fernet
+
+    def load_clients(self):
+        """Import the Mattermost, LDAP and crypto libraries when they are first needed"""
+        seconds = import_clients()
+        if seconds:
+            self.metrics.observe('import_clients_seconds', seconds)
+            self.log.info('Mattermost clients imported in {:.0f}ms'.format(seconds * 1000))
+
     def deactivate(self):
         """
         Triggers on plugin deactivation
 
         You should delete it if you're not using it to override any default behaviour
         """
+        if self.sessions is not None:
+            self.sessions.clear()
+        if self.jobs is not None:
+            self.jobs.shutdown()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
         super(Mattermost, self).deactivate()
 
     def get_configuration_template(self):
@@ -99,14 +926,56 @@ class Mattermost(BotPlugin):
             'MM_CHANNEL': '#mattermost',
             'MM_DEBUG': False,
             'MM_ENCRYPTED_ACCESS_TOKEN': None,
+            'MM_SESSION_TTL': 3600,
+            'MM_PAGE_WORKERS': 4,
+            'MM_RATE_LIMIT': 10,
+            'MM_RATE_BURST': 100,
+            'MM_MAX_RETRIES': 5,
+            'JOB_WORKERS': 2,
+            'JOB_HISTORY': 50,
             'LDAP_URI': 'ldaps://localhost:636',
             'LDAP_BIND_USER': 'cn=username,ou=org,dc=example,dc=com',
             'LDAP_BIND_ENCRYPTED_PASSWORD': 'ENCRYPTED_PASSWORD',
             'LDAP_SEARCH_BASE': 'ou=BASE,dc=example,dc=com',
+            'LDAP_CACHE_TTL': 300,
+            'USER_CACHE_SIZE': 50000,
+            'USER_BULK_WORKERS': 4,
+            'LDAP_NEGATIVE_CACHE_TTL': 3600,
+            'LDAP_POOL_SIZE': 4,
+            'LDAP_WATCH_INTERVAL': 0,
+            'LDAP_WATCH_FILTER': '(objectClass=*)',
+            'LDAP_WATCH_ATTRIBUTE': 'modifyTimestamp',
+            'LDAP_GROUP_ATTRIBUTE': 'cn',
+            'LDAP_GROUP_NAME': '{section}',
+            'LDAP_USERNAME_ATTRIBUTE': 'uid',
             'ADMINS': ('@mmadmin',),
-            'SYNC_FREQUENCY': 600
+            'SYNC_FREQUENCY': 600,
+            'SYNC_SHARDS': 10,
+            'SYNC_WORKERS': 4,
+            'SYNC_INCREMENTAL': True,
+            'SYNC_REMOVE': False,
+            'SYNC_REMOVE_EXEMPT_ROLES': ('team_admin',),
+            'SYNC_REMOVE_MAX': 50,
+            'SYNC_REMOVE_BATCH': 10,
+            'SYNC_DRY_RUN': False,
+            'SYNC_PROGRESS_INTERVAL': 30,
+            'SYNC_HISTORY_SIZE': 20,
+            'SYNC_ORDER': 'slowest',
+            'SYNC_MAX_INTERVAL': 3600,
+            'SYNC_ATTACH_OUTPUT': True,
+            'SYNC_MAX_RESUMES': 3,
+            'METRICS_PORT': 0
         }
 
+    def configure(self, configuration):
+        """
+        Triggers when the plugin is configured, fill in the defaults for the options that are missing from the
+        configuration so that the existing configurations keep working when a new option is introduced
+        """
+        if configuration:
+            configuration = dict(chain(self.get_configuration_template().items(), configuration.items()))
+        super(Mattermost, self).configure(configuration)
+
     def check_configuration(self, configuration):
         """
         Triggers when the configuration is checked, shortly before activation
@@ -115,7 +984,8 @@ class Mattermost(BotPlugin):
 
         You should delete it if you're not using it to override any default behaviour
         """
-        super(Mattermost, self).check_configuration(configuration)
+        super(Mattermost, self).check_configuration(
+            dict(chain(self.get_configuration_template().items(), configuration.items())))
 
     def callback_connect(self):
         """
@@ -171,83 +1041,289 @@ class Mattermost(BotPlugin):
     @botcmd
     def mm_token_set(self, message, args):
         """Set encrypted access token to be used for ad-hoc command"""
+        # the exceptions below are imported with the clients, an import error is raised as is
+        self.load_clients()
         # check if it is a valid token
         try:
             self.init_mm(args)
         except (NoAccessTokenProvided, InvalidToken):
             return 'Hmmm, it seems you have an incorrect token. Have you encrypted it?'
-        self.tokens[message.frm.person] = args
-        self['tokens'] = self.tokens
+        with self.storage_lock:
+            self[self.TOKEN_KEY.format(message.frm.person)] = args
+            self.tokens[message.frm.person] = args
         return "Mattermost access token is set"
 
     @botcmd
     def mm_token_show(self, message, args):
         """Show encrypted access token to be used for ad-hoc command"""
-        if 'tokens' not in self or message.frm.person not in self['tokens']:
+        if message.frm.person not in self.tokens:
             return 'No token'
         else:
-            return str(self['tokens'][message.frm.person])
+            return str(self.tokens[message.frm.person])
 
     @botcmd(admin_only=True)
     def mm_token_list(self, message, args):
         """List all encrypted access token stored"""
-        if 'tokens' in self:
-            return str(self['tokens'])
-        else:
-            return '{}'
+        return str(self.tokens)
 
     @botcmd()
     def mm_mapping_list(self, message, args):
         """List all course mappings used for automatic syncing"""
-        return str(self['course_mappings'])
+        return str(set(self.course_mappings))
 
     @botcmd()
     def mm_mapping_add(self, message, args):
         """Manually add a course to course mappings for automatic syncing"""
-        self.course_mappings.add(args)
-        self['course_mappings'] = self.course_mappings
+        self.add_mapping(args)
+        self.course_changed_at[args] = time.time()
         return 'Course {} is added to course mappings. We have {} courses in the mapping'.format(
-            args, len(self['course_mappings'])
+            args, len(self.course_mappings)
         )
 
     @botcmd()
     def mm_mapping_remove(self, message, args):
         """Remove a course to course mappings for automatic syncing"""
-        self.course_mappings.remove(args)
-        self['course_mappings'] = self.course_mappings
+        self.remove_mapping(args)
         return 'Course {} is removed from course mappings. We have {} courses in the mapping'.format(
-            args, len(self['course_mappings'])
+            args, len(self.course_mappings)
         )
 
+    @botcmd()
+    def mm_mapping_stats(self, message, args):
+        """
+        Show the sync history of a course, its sync time, roster size, changes and failures. Without a course, show the
+        courses taking the most time to sync and changing the most
+        """
+        course = args.strip()
+        if not course:
+            histories = dict((c, self.get_sync_history(c)) for c in self.course_mappings)
+            histories = dict((c, h) for c, h in histories.items() if h)
+            if not histories:
+                return 'No course is synced yet.'
+            lines = ['Courses taking the most time to sync:']
+            lines.extend('{} - {:.1f}s on average'.format(c, self.sync_trend(h)['seconds'])
+                         for c, h in sorted(histories.items(), key=lambda t: -self.sync_trend(t[1])['seconds'])[:10])
+            lines.append('Courses changing the most:')
+            lines.extend('{} - {:.1f} students added or removed per sync'.format(c, self.sync_trend(h)['changes'])
+                         for c, h in sorted(histories.items(), key=lambda t: -self.sync_trend(t[1])['changes'])[:10])
+            return '\n'.join(lines)
+
+        if course not in self.course_mappings:
+            return 'Course {} is not in the course mappings.'.format(course)
+        history = self.get_sync_history(course)
+        if not history:
+            return 'Course {} is not synced yet.'.format(course)
+        trend = self.sync_trend(history)
+        last = history[-1]
+        statuses = defaultdict(int)
+        for entry in history:
+            statuses[entry['status']] += 1
+        return '\n'.join([
+            'Course {}: {} syncs since {}, the last one {} at {}.'.format(
+                course, len(history), time.strftime('%Y-%m-%d %H:%M', time.localtime(history[0]['time'])),
+                last['status'], time.strftime('%Y-%m-%d %H:%M', time.localtime(last['time']))),
+            'Outcomes: {}'.format(', '.join('{} {}'.format(n, status) for status, n in sorted(statuses.items()))),
+            'Sync time: {:.1f}s on average, {:.1f}s at most, {:.1f}s last time'.format(
+                trend['seconds'], max(e['seconds'] for e in history), last['seconds']),
+            'Students in LDAP: {} last time, {} to {}'.format(
+                last['ldap'], min(e['ldap'] for e in history), max(e['ldap'] for e in history)),
+            'Per sync: {:.1f} users created, {:.1f} added, {:.1f} removed, {:.1f} failed'.format(
+                *(sum(e[f] for e in history) / len(history) for f in ('created', 'added', 'removed', 'failed'))),
+            'Scheduled every {:.0f}s, {} syncs in a row found nothing to change.'.format(
+                self.course_interval(history), trend['quiet']),
+        ])
+
+    @botcmd()
+    def mm_mapping_import(self, message, args):
+        """
+        Add many courses to course mappings at once and create their teams, the course specs can be separated by
+        spaces, commas or new lines
+        """
+        # check if personal token is set
+        if message.frm.person not in self.tokens:
+            yield 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
+            return
+
+        # parse everything up front, so a typo doesn't leave half of the import done
+        self.load_clients()
+        specs = list(dict.fromkeys(spec for spec in re.split(r'[\s,]+', args) if spec))
+        teams = {}
+        parsed = {}
+        invalid = []
+        for spec in specs:
+            try:
+                parsed[spec] = parse_course(spec)
+                teams.setdefault(parsed[spec][1], []).append(spec)
+            except Exception as e:
+                invalid.append('{} ({})'.format(spec, e))
+        if invalid:
+            yield 'Nothing is imported, I can\'t parse these course specs:\n{}'.format('\n'.join(invalid))
+            return
+        if not specs:
+            yield 'Please give me the course specs to import.'
+            return
+
+        token = self.tokens[message.frm.person]
+        try:
+            mm = self.init_mm(token)
+        except Exception as e:
+            yield e
+            return
+
+        team_ids = {}
+
+        def create_team(team_name):
+            try:
+                team = mm.get_team_by_name(team_name)
+                result = 'existing'
+                if not team:
+                    team = mm.create_team(team_name)
+                    result = 'created'
+                team_ids[team_name] = team['id']
+                return result
+            except HTTPError as e:
+                self.log.error('Failed to create team {}: {}'.format(team_name, e.args))
+                return 'failed'
+
+        with ThreadPoolExecutor(self.config['SYNC_WORKERS'], thread_name_prefix='mm-import') as executor:
+            results = dict(zip(teams, executor.map(create_team, teams)))
+
+        imported = [spec for team_name, team_specs in teams.items() if results[team_name] != 'failed'
+                    for spec in team_specs]
+        added = [spec for spec in imported if self.add_mapping(spec)]
+        for spec in imported:
+            source_courses, team_name = parsed[spec]
+            self.update_mapping(spec, source_courses=list(source_courses), team_name=team_name,
+                                team_id=team_ids[team_name])
+        now = time.time()
+        for spec in added:
+            self.course_changed_at[spec] = now
+
+        failed = [team_name for team_name, result in results.items() if result == 'failed']
+        summary = 'OK, {} courses are added to course mappings, {} were there already. Created {} teams, {} teams ' \
+                  'exist already. We have {} courses in the mapping.'.format(
+                      len(added), len(imported) - len(added),
+                      sum(1 for r in results.values() if r == 'created'),
+                      sum(1 for r in results.values() if r == 'existing'), len(self.course_mappings))
+        if failed:
+            summary += '\nFailed to create these teams, their courses are not added: {}'.format(', '.join(failed))
+        yield summary
+
+    @botcmd()
+    def mm_job_list(self, message, args):
+        """List the background jobs, the running and queued ones and the last finished ones"""
+        jobs = self.jobs.list()
+        if not jobs:
+            return 'No job.'
+        return '\n'.join(self.describe_job(job) for job in jobs)
+
+    @arg_botcmd('job_id', type=int)
+    def mm_job_status(self, message, job_id):
+        """Show the status and the last output of a background job"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return 'I can\'t find job {}.'.format(job_id)
+        return '\n'.join([self.describe_job(job)] + list(job.output))
+
+    @arg_botcmd('job_id', type=int)
+    def mm_job_cancel(self, message, job_id):
+        """Cancel a background job, a running sync stops before its next course"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return 'I can\'t find job {}.'.format(job_id)
+        if job.owner != message.frm.person and \
+                message.frm.person not in self.config['ADMINS'] + self.bot_config.BOT_ADMINS:
+            return 'Only {} or an admin can cancel job {}.'.format(job.owner, job_id)
+        if job.finished:
+            return 'Job {} is {} already.'.format(job_id, job.status)
+        self.jobs.cancel(job)
+        return 'OK, job {} is cancelled.'.format(job_id) if job.finished else \
+            'OK, job {} stops after the courses in progress.'.format(job_id)
+
     @botcmd(admin_only=True)
     def mm_scheduler_start(self, message, args):
         """Start scheduler for automatic syncing"""
         if not self.config['MM_ENCRYPTED_ACCESS_TOKEN']:
             yield 'I need MM_ENCRYPTED_ACCESS_TOKEN in the configuration to be set in order to use scheduled sync.'
             return
-        self.start_poller(self.config['SYNC_FREQUENCY'], self.refresh)
+        self.start_poller(self.refresh_interval(), self.refresh)
+        if self.config['LDAP_WATCH_INTERVAL']:
+            self.start_poller(self.config['LDAP_WATCH_INTERVAL'], self.watch_changes)
         yield 'OK, automatic sync started.'
 
     @botcmd(admin_only=True)
     def mm_scheduler_stop(self, message, args):
         """Stop scheduler for automatic syncing"""
         self.stop_poller(self.refresh)
+        if self.config['LDAP_WATCH_INTERVAL']:
+            self.stop_poller(self.watch_changes)
         yield 'OK, automatic sync stopped.'
 
+    @botcmd()
+    def mm_stats(self, message, args):
+        """Show the sync metrics, the courses taking the most of the sync time and the startup timing"""
+        m = self.metrics
+        api = m.timers('mm_api_seconds')
+        ldap = m.timers('ldap_query_seconds')
+        logins = m.timers('init_mm_seconds')
+        imports = m.timers('import_clients_seconds')
+        ldap_count = sum(v[0] for v in ldap.values())
+        lines = [
+            'Sync runs: {:.0f}, courses synced: {}, skipped as unchanged: {:.0f}, failed: {:.0f}'.format(
+                m.total('sync_runs_total'), sum(v[0] for v in m.timers('sync_course_seconds').values()),
+                m.total('sync_courses_skipped_total'), m.total('sync_errors_total')),
+            'Users added: {:.0f}, created or looked up: {:.0f}, failed: {:.0f}, removed: {:.0f}'.format(
+                m.total('sync_users_added_total'), m.total('sync_users_resolved_total'),
+                m.total('sync_users_failed_total'), m.total('sync_users_removed_total')),
+            'Mattermost API calls: {}, {:.1f}s in total, errors: {:.0f}, rate limited: {:.0f}'.format(
+                sum(v[0] for v in api.values()), sum(v[1] for v in api.values()),
+                sum(v for labels, v in m.counters('mm_api_calls_total').items() if dict(labels)['status'] == 'error'),
+                sum(v for labels, v in m.counters('mm_api_calls_total').items()
+                    if dict(labels)['status'] == 'throttled')),
+            'LDAP queries: {}, {:.0f}ms on average'.format(
+                ldap_count, sum(v[1] for v in ldap.values()) * 1000 / ldap_count if ldap_count else 0),
+            'Logins: {}, session reused: {}'.format(
+                sum(v[0] for k, v in logins.items() if dict(k).get('cached') == 'no'),
+                sum(v[0] for k, v in logins.items() if dict(k).get('cached') == 'yes')),
+            'Startup: activated in {:.0f}ms, clients imported {}'.format(
+                (self.activate_seconds or 0) * 1000,
+                'in {:.0f}ms'.format(imports[()][1] * 1000) if () in imports else 'on first use'),
+        ]
+        courses = sorted(m.timers('sync_course_seconds').items(), key=lambda t: t[1][1], reverse=True)[:10]
+        if courses:
+            lines.append('Courses taking the most sync time:')
+            lines.extend('{} - {:.1f}s in {} runs, max {:.1f}s'.format(dict(labels)['course'], total, runs, maximum)
+                         for labels, (runs, total, maximum) in courses)
+        return '\n'.join(lines)
+
+    @botcmd()
+    def mm_cache_stats(self, message, args):
+        """Show the size and hit rate of the session, LDAP and user caches"""
+        return '\n'.join(
+            '{}: {} entries, {} hits, {} misses'.format(name, len(cache), cache.hits, cache.misses)
+            for name, cache in (('Sessions', self.sessions), ('LDAP courses', self.ldap_cache),
+                                ('Users', self.user_cache))
+        )
+
+    @botcmd()
+    def mm_cache_clear(self, message, args):
+        """Flush the LDAP course and user caches, the next sync reads the rosters from LDAP again"""
+        self.ldap_cache.clear()
+        self.user_cache.clear()
+        return 'OK, LDAP course and user caches are cleared.'
+
     @arg_botcmd('course_spec')
     @arg_botcmd('--once', dest='once', action='store_true')
-    def mm_sync(self, message, course_spec, once):
+    @arg_botcmd('--full', dest='full', action='store_true')
+    @arg_botcmd('--dry-run', dest='dry_run', action='store_true')
+    def mm_sync(self, message, course_spec, once, full, dry_run):
         """Ad-hoc sync LDAP to MM team"""
-        if course_spec.lower() == 'all':
-            courses = self['course_mappings']
-        else:
-            courses = (course_spec,)
-
         # check if personal token is set
-        if 'tokens' not in self or message.frm.person not in self['tokens']:
+        if message.frm.person not in self.tokens:
             yield 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
+            return
 
-        token = self['tokens'][message.frm.person]
+        token = self.tokens[message.frm.person]
 
         try:
             mm = self.init_mm(token)
@@ -255,26 +1331,37 @@ class Mattermost(BotPlugin):
             yield e
             return
 
-        for msg in self.sync(courses, mm):
-            yield msg
+        yield self.enqueue(message, 'sync of {}{}'.format(course_spec, ' (dry run)' if dry_run else ''),
+                           lambda job: self.run_sync(job, message, mm, course_spec, once, full, dry_run))
 
-        # store the mapping
-        if course_spec.lower() != 'all' and not once:
-            self.course_mappings.add(course_spec)
-            self['course_mappings'] = self.course_mappings
-
-        return
+    @botcmd()
+    def mm_sync_status(self, message, args):
+        """Show the progress of the scheduled sync and of the last sync of all courses"""
+        lines = []
+        for name, title in (('refresh', 'Scheduled sync'), ('all', 'Sync of all courses')):
+            state = self.get_checkpoint(name)
+            if state is None:
+                lines.append('{}: never run'.format(title))
+                continue
+            lines.append('{} `{}`: {}, {} of {} courses done, started {}, last progress {}'.format(
+                title, state['run_id'], 'finished' if state['finished'] else 'in progress or interrupted',
+                len(state['done']), len(state['courses']),
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['started'])),
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['updated']))))
+            lines.extend('    {} - {}'.format(course, step) for course, step in sorted(state['steps'].items())
+                         if step not in self.SYNC_DONE_STEPS)
+        return '\n'.join(lines)
 
     @arg_botcmd('team_name')
     @arg_botcmd('username')
-    @arg_botcmd('--role', dest='role', default='user', choices=['admin', 'user'])
+    @arg_botcmd('--role', dest='role', default=None, choices=['admin', 'user'])
     def mm_user_add(self, message, username, team_name, role):
-        """Add a user to a team"""
+        """Add a user to a team, as a user unless --role is given. The role of a member is changed only with --role"""
         # check if personal token is set
-        if 'tokens' not in self or message.frm.person not in self['tokens']:
+        if message.frm.person not in self.tokens:
             yield 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
 
-        token = self['tokens'][message.frm.person]
+        token = self.tokens[message.frm.person]
         try:
             mm = self.init_mm(token)
         except Exception as e:
@@ -293,7 +1380,8 @@ class Mattermost(BotPlugin):
         try:
             user = mm.driver.users.get_user_by_username(username)
         except ResourceNotFound:
-            u = mm.get_users_from_ldap(username)
+            with self.ldap_connection(mm) as ldap, self.metrics.timer('ldap_query_seconds', query='user'):
+                u = ldap.get_users_from_ldap(username)
             if not u:
                 yield 'I can\'t find user with username `{}` in LDAP'.format(username)
                 return
@@ -303,21 +1391,59 @@ class Mattermost(BotPlugin):
                 return
             user = created_users[0]
 
-        mm.add_users_to_team([user], team['id'], self.ROLES[role])
-        if role == 'admin':
+        try:
+            current = RosterDiff.from_members([mm.driver.teams.get_team_member(team['id'], user['id'])])
+        except ResourceNotFound:
+            current = {}
+        # without --role the roles of a member are kept, an admin is not demoted
+        diff = RosterDiff(RosterDiff.from_users([user], self.ROLES[role] if role else None), current)
+        role = role or 'user'
+
+        if diff.to_add:
+            mm.add_users_to_team([user], team['id'], self.ROLES[role])
+            if role == 'admin':
+                mm.driver.teams.update_team_member_roles(team['id'], user['id'], {'roles': self.ROLES[role]})
+        elif diff.to_change:
             mm.driver.teams.update_team_member_roles(team['id'], user['id'], {'roles': self.ROLES[role]})
+            yield 'OK, user `{}` is already in team `{}`, I changed the role to `{}`'.format(username, team_name, role)
+            return
+        else:
+            yield 'User `{}` is already in team `{}`'.format(username, team_name)
+            return
 
         yield 'OK, I added user `{}` to team `{}` as `{}`'.format(username, team_name, role)
 
+    @arg_botcmd('usernames', nargs='+')
+    @arg_botcmd('team_name')
+    @arg_botcmd('--role', dest='role', default=None, choices=['admin', 'user'])
+    def mm_users_add(self, message, team_name, usernames, role):
+        """Add many users to a team, the usernames can be separated by spaces, commas or new lines"""
+        # check if personal token is set
+        if message.frm.person not in self.tokens:
+            yield 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
+            return
+
+        usernames = split_usernames(usernames)
+
+        token = self.tokens[message.frm.person]
+        try:
+            mm = self.init_mm(token)
+        except Exception as e:
+            yield e
+            return
+
+        yield self.enqueue(message, 'adding {} users to team {}'.format(len(usernames), team_name),
+                           lambda job: self.users_add(mm, team_name, usernames, role))
+
     @arg_botcmd('team_name')
     @arg_botcmd('username')
     def mm_user_remove(self, message, username, team_name):
         """Remove a user from a team"""
         # check if personal token is set
-        if 'tokens' not in self or message.frm.person not in self['tokens']:
+        if message.frm.person not in self.tokens:
             yield 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
 
-        token = self['tokens'][message.frm.person]
+        token = self.tokens[message.frm.person]
         try:
             mm = self.init_mm(token)
         except Exception as e:
@@ -359,10 +1485,10 @@ class Mattermost(BotPlugin):
     def mm_user_activate(self, message, username):
         """Activate a user"""
         # check if personal token is set
-        if 'tokens' not in self or message.frm.person not in self['tokens']:
+        if message.frm.person not in self.tokens:
             yield 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
 
-        token = self['tokens'][message.frm.person]
+        token = self.tokens[message.frm.person]
         try:
             mm = self.init_mm(token)
             yield self.change_user_active_statue(mm, username, True)
@@ -374,10 +1500,10 @@ class Mattermost(BotPlugin):
     def mm_user_deactivate(self, message, username):
         """Activate a user"""
         # check if personal token is set
-        if 'tokens' not in self or message.frm.person not in self['tokens']:
+        if message.frm.person not in self.tokens:
             yield 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
 
-        token = self['tokens'][message.frm.person]
+        token = self.tokens[message.frm.person]
         try:
             mm = self.init_mm(token)
             yield self.change_user_active_statue(mm, username, False)
@@ -390,10 +1516,10 @@ class Mattermost(BotPlugin):
     def mm_user_get(self, message, username, full):
         """Get user info by username"""
         # check if personal token is set
-        if 'tokens' not in self or message.frm.person not in self['tokens']:
+        if message.frm.person not in self.tokens:
             yield 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
 
-        token = self['tokens'][message.frm.person]
+        token = self.tokens[message.frm.person]
         try:
             mm = self.init_mm(token)
             user = mm.driver.users.get_user_by_username(username)
@@ -418,10 +1544,10 @@ class Mattermost(BotPlugin):
     def mm_user_update(self, message, username, to_username, email, firstname, lastname, nickname):
         """Update user info"""
         # check if personal token is set
-        if 'tokens' not in self or message.frm.person not in self['tokens']:
+        if message.frm.person not in self.tokens:
             yield 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
 
-        token = self['tokens'][message.frm.person]
+        token = self.tokens[message.frm.person]
         try:
             opt = {}
             if to_username is not None:
@@ -481,15 +1607,46 @@ class Mattermost(BotPlugin):
             yield e
             return
 
+    @arg_botcmd('usernames', nargs='*')
+    @arg_botcmd('--ldap-filter', dest='ldap_filter')
+    def mm_users_activate(self, message, usernames, ldap_filter):
+        """
+        Activate many users, the usernames can be separated by spaces, commas or new lines, or come from a LDAP filter
+        """
+        return self.enqueue_users_change(message, usernames, ldap_filter, 'activate', self.activate_user)
+
+    @arg_botcmd('usernames', nargs='*')
+    @arg_botcmd('--ldap-filter', dest='ldap_filter')
+    def mm_users_deactivate(self, message, usernames, ldap_filter):
+        """
+        Deactivate many users, the usernames can be separated by spaces, commas or new lines, or come from a LDAP
+        filter
+        """
+        return self.enqueue_users_change(message, usernames, ldap_filter, 'deactivate', self.deactivate_user)
+
+    @arg_botcmd('usernames', nargs='*')
+    @arg_botcmd('--ldap-filter', dest='ldap_filter')
+    @arg_botcmd('--nickname', dest='nickname')
+    @arg_botcmd('--ldap-auth', dest='ldap_auth', action='store_true')
+    def mm_users_update(self, message, usernames, ldap_filter, nickname, ldap_auth):
+        """
+        Update many users, set their nickname or switch them to LDAP authentication. The usernames can be separated
+        by spaces, commas or new lines, or come from a LDAP filter
+        """
+        if nickname is None and not ldap_auth:
+            return 'Please specify what to update, `--nickname` or `--ldap-auth`.'
+        return self.enqueue_users_change(message, usernames, ldap_filter, 'update',
+                                         lambda mm, user: self.update_user(mm, user, nickname, ldap_auth))
+
     @arg_botcmd('team_name')
     @arg_botcmd('--display-name', dest='display_name')
     @arg_botcmd('--type', dest='team_type', default='I', choices=['O', 'I'])
     def mm_team_add(self, message, team_name, display_name, team_type):
         # check if personal token is set
-        if 'tokens' not in self or message.frm.person not in self['tokens']:
+        if message.frm.person not in self.tokens:
             yield 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
 
-        token = self['tokens'][message.frm.person]
+        token = self.tokens[message.frm.person]
         try:
             mm = self.init_mm(token)
         except Exception as e:
@@ -501,9 +1658,11 @@ class Mattermost(BotPlugin):
         try:
             team = mm.get_team_by_name(team_name)
             if team:
+                self.set_team_id(team_name, team['id'])
                 return 'Team {} already exists.'.format(team_name)
             else:
-                mm.create_team(team_name, display_name, team_type)
+                team = mm.create_team(team_name, display_name, team_type)
+                self.set_team_id(team_name, team['id'])
                 return 'Team {} is created.'.format(team_name)
         except HTTPError as e:
             self.log.error('Failed to create team {}: {}'.format(team_name, e.args))
@@ -513,28 +1672,330 @@ class Mattermost(BotPlugin):
     def mm_team_list(self, message, args):
         """List all teams in in Mattermost"""
         # check if personal token is set
-        if 'tokens' not in self or message.frm.person not in self['tokens']:
+        if message.frm.person not in self.tokens:
             yield 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
+            return
 
-        token = self['tokens'][message.frm.person]
+        token = self.tokens[message.frm.person]
         try:
             mm = self.init_mm(token)
+        except Exception as e:
+            yield e
+            return
+
+        yield self.enqueue(message, 'team list', lambda job: self.team_list(mm))
+
+    def output_aggregator(self, total=None, unit='courses'):
+        """OutputAggregator for a command, sized to the messages of the chat backend"""
+        return OutputAggregator(self.bot_config.MESSAGE_SIZE_LIMIT or MAX_MESSAGE_SIZE,
+                                self.config['SYNC_PROGRESS_INTERVAL'], total, unit)
+
+    def send_output(self, message, report, name):
+        """Send the whole output of the command as a file, where the command is run"""
+        if not self.config['SYNC_ATTACH_OUTPUT'] or not report.detail:
+            return
+        fsource, size = report.attachment()
+        try:
+            self.send_stream_request(self.reply_target(message), fsource, name, size, 'text/plain')
+        except Exception as e:
+            # not every chat backend can send files, the summary is there anyway
+            self.log.warning('Failed to send the output as a file: {}'.format(e))
+
+    def reply_target(self, message):
+        """Where to send the messages of a command, the room or the person"""
+        return message.to if message.is_group else message.frm
+
+    def enqueue(self, message, name, func):
+        """Run func as a background job, its messages are sent to where the command is run"""
+        target = self.reply_target(message)
+        job = self.jobs.submit(name, message.frm.person, func, lambda msg: self.send(target, str(msg)))
+        return 'OK, {} is queued as job {}. Use `!mm job status {}` to check on it.'.format(name, job.id, job.id)
+
+    @staticmethod
+    def describe_job(job):
+        return '{} - {} by {} - {}, {}'.format(
+            job.id, job.name, job.owner, job.status,
+            'queued {}'.format(time.strftime('%H:%M:%S', time.localtime(job.created))) if job.started is None else
+            'took {:.0f}s'.format(job.finished - job.started) if job.finished else
+            'running for {:.0f}s'.format(time.time() - job.started))
+
+    def run_sync(self, job, message, mm, course_spec, once, full, dry_run):
+        """The sync of a course or of all the courses for mm_sync, also a generator"""
+        if course_spec.lower() == 'all':
+            courses = list(self.course_mappings)
+        else:
+            courses = (course_spec,)
+
+        # many courses are reported as a progress summary instead of the messages of every step
+        report = self.output_aggregator(len(courses)) if len(courses) > 1 else None
+
+        if dry_run:
+            for msg in self.plan(courses, mm, full, report):
+                yield msg
+        else:
+            # a sync of all the courses picks up where the last unfinished one stopped, unless --full is given
+            checkpoint = None
+            if course_spec.lower() == 'all':
+                checkpoint = 'all'
+                if full:
+                    self.clear_checkpoint(checkpoint)
+
+            for msg in self.sync(courses, mm, full, checkpoint, report, job):
+                yield msg
+
+        if report:
+            for msg in report.summary():
+                yield msg
+            self.send_output(message, report, 'mm-sync-{}.log'.format(time.strftime('%Y%m%d-%H%M%S')))
+        if dry_run or job.cancelled.is_set():
+            return
+
+        # store the mapping
+        if course_spec.lower() != 'all' and not once:
+            self.add_mapping(course_spec)
+            self.course_changed_at[course_spec] = time.time()
+
+    def users_add(self, mm, team_name, usernames, role=None):
+        """
+        Add the users to the team as the role, the missing ones are created from LDAP. Also a generator. The roles of
+        the members already in the team are changed only when the role is given
+        """
+        try:
+            team = mm.driver.teams.get_team_by_name(team_name)
+        except ResourceNotFound:
+            yield 'I can\'t find team under name `{}` in the system.'.format(team_name)
+            return
+        except Exception as e:
+            yield e
+            return
+
+        try:
+            # resolve the existing users in batches, then look up the rest in LDAP and create them in one go. Sync
+            # looks up one user at a time, the lookups are spread over the LDAP connections of the session
+            users = self.lookup_users(mm, usernames)
+            missing = set(usernames) - set(member_key(u) for u in users)
+            ldap_users = []
+            not_found = []
+
+            def ldap_user(username):
+                with self.ldap_connection(mm) as ldap, self.metrics.timer('ldap_query_seconds', query='user'):
+                    return username, ldap.get_users_from_ldap(username)
+
+            with ThreadPoolExecutor(max(self.config['LDAP_POOL_SIZE'], 1), thread_name_prefix='mm-ldap') as executor:
+                for username, u in executor.map(ldap_user, sorted(missing)):
+                    if u:
+                        ldap_users.extend(u)
+                    else:
+                        not_found.append(username)
+            failed_users = []
+            if ldap_users:
+                created_users, failed_users = mm.create_users(ldap_users)
+                users.extend(created_users)
+
+            current = RosterDiff.from_members(
+                mm.driver.teams.get_team_members_by_id(team['id'], [u['id'] for u in users])) if users else {}
+            diff = RosterDiff(RosterDiff.from_users(users, self.ROLES[role] if role else None), current)
+            role = role or 'user'
+            users_to_add = [u for u in users if u['id'] in diff.to_add]
+            if users_to_add:
+                mm.add_users_to_team(users_to_add, team['id'], self.ROLES[role])
+            for user_id in (diff.to_add | diff.to_change if role == 'admin' else diff.to_change):
+                mm.driver.teams.update_team_member_roles(team['id'], user_id, {'roles': self.ROLES[role]})
+        except HTTPError as e:
+            self.log.error('Failed to add users to team {}: {}'.format(team_name, e.args))
+            yield 'Failed to add users to team {}: {}'.format(team_name, e.args)
+            return
+
+        summary = 'OK, I added {} users to team `{}` as `{}`.'.format(len(users_to_add), team_name, role)
+        if diff.to_change:
+            summary += ' Changed the role of {} users already in the team.'.format(len(diff.to_change))
+        unchanged = len(users) - len(users_to_add) - len(diff.to_change)
+        if unchanged:
+            summary += ' {} users are already in the team.'.format(unchanged)
+        if not_found:
+            summary += '\nI can\'t find these users in LDAP: {}'.format(', '.join(not_found))
+        if failed_users:
+            summary += '\nI have some troubles to create {} users. Checkout the logs or try again later.'.format(
+                len(failed_users))
+        yield summary
+
+    def enqueue_users_change(self, message, usernames, ldap_filter, action, change):
+        """Queue a job applying change to the users of a bulk command"""
+        # check if personal token is set
+        if message.frm.person not in self.tokens:
+            return 'Please use `!mm token set ENCRYPTED_ACCESS_TOKEN` to set up Mattermost access token.'
+        usernames = split_usernames(usernames)
+        if not usernames and not ldap_filter:
+            return 'Please give the usernames or a LDAP filter with `--ldap-filter`.'
+
+        try:
+            mm = self.init_mm(self.tokens[message.frm.person])
         except Exception as e:
             return e
 
-        teams = []
-        for i in range(1000):
-            t = mm.driver.teams.get_teams({'page': i, 'per_page': 60})
-            teams.extend(t)
-            if len(t) < 60:
-                break
+        name = '{} of {}'.format(action, ' and '.join(filter(None, (
+            '{} users'.format(len(usernames)) if usernames else None,
+            'LDAP filter {}'.format(ldap_filter) if ldap_filter else None))))
+        return self.enqueue(message, name,
+                            lambda job: self.users_change(job, message, mm, usernames, ldap_filter, action, change))
 
-        yield 'OK, here is a list of teams:\nName - Display Name\n' + '\n'.join(
-            ['{} - {}'.format(t['name'], t['display_name']) for t in teams]
-        ) if teams else 'I don\'t see any team.'
+    def users_change(self, job, message, mm, usernames, ldap_filter, action, change):
+        """
+        Apply change to many users, also a generator. The users are looked up in batches and changed concurrently by
+        USER_BULK_WORKERS, change(mm, user) makes the calls for a user and returns whether anything is changed. The
+        bot itself and the system admins found by the LDAP filter are skipped, only the named ones are changed
+        """
+        named = set(usernames)
+        if ldap_filter:
+            try:
+                usernames = list(dict.fromkeys(usernames + self.search_usernames(ldap_filter)))
+            except Exception as e:
+                self.log.error('Failed to search LDAP with {}: {}'.format(ldap_filter, e))
+                yield 'Failed to search LDAP with {}: {}'.format(ldap_filter, e)
+                return
+        try:
+            users = self.lookup_users(mm, usernames) if usernames else []
+        except HTTPError as e:
+            yield 'Failed to look up the users: {}'.format(e.args)
+            return
+        found = set(member_key(u) for u in users)
+        not_found = [u for u in usernames if u not in found]
+        skipped = [u['username'] for u in users if member_key(u) not in named and self.protected_user(mm, u)]
+        users = [u for u in users if u['username'] not in skipped]
+        yield 'OK, I am going to {} {} users.'.format(action, len(users))
+
+        def apply(user):
+            if job is not None and job.cancelled.is_set():
+                return 'cancelled', None
+            # one bad record fails only its own user, the others are still changed and reported
+            try:
+                changed = change(mm, user)
+            except HTTPError as e:
+                self.log.error('Failed to {} user {}: {}'.format(action, user['username'], e.args))
+                return 'failed', 'Failed to {} user `{}`: {}'.format(action, user['username'], e.args)
+            except Exception as e:
+                self.log.exception('Failed to {} user {}'.format(action, user.get('username')))
+                return 'failed', 'Failed to {} user `{}`: {}'.format(action, user.get('username'), e)
+            if changed:
+                return 'changed', 'User `{}` is {}d.'.format(user['username'], action)
+            return 'unchanged', 'User `{}` is unchanged.'.format(user['username'])
+
+        # there is no bulk API for these, the calls of the users go out concurrently under the rate limit
+        report = self.output_aggregator(len(users), 'users')
+        results = defaultdict(int)
+        with ThreadPoolExecutor(self.config['USER_BULK_WORKERS'], thread_name_prefix='mm-users') as executor:
+            futures = dict((executor.submit(apply, user), user) for user in users)
+            for future in as_completed(futures):
+                status, msg = future.result()
+                results[status] += 1
+                self.metrics.inc('bulk_users_total', action=action, status=status)
+                for m in report.course(futures[future]['username'], [msg] if msg else []):
+                    yield m
+
+        summary = 'Done. {} users are {}d, {} are unchanged.'.format(results['changed'], action, results['unchanged'])
+        if results['failed']:
+            summary += ' Failed to {} {} users, checkout the logs.'.format(action, results['failed'])
+        if results['cancelled']:
+            summary += ' {} users are left as is, the job is cancelled.'.format(results['cancelled'])
+        if skipped:
+            report.detail.append('Skipped as the bot or system admins: {}'.format(', '.join(skipped)))
+            summary += ' {} users are skipped as the bot or system admins{}.'.format(
+                len(skipped), ': ' + ', '.join(skipped) if len(skipped) <= MAX_REPORTED_PROBLEMS else '')
+        if not_found:
+            report.detail.append('Not found in Mattermost: {}'.format(', '.join(not_found)))
+            summary += ' {} users are not found in Mattermost{}.'.format(
+                len(not_found), ': ' + ', '.join(not_found) if len(not_found) <= MAX_REPORTED_PROBLEMS else '')
+        yield summary
+        for m in report.summary():
+            yield m
+        self.send_output(message, report, 'users-{}.txt'.format(action))
+
+    @staticmethod
+    def activate_user(mm, user):
+        """Activate the user, a user without auth data is switched to LDAP authentication first"""
+        changed = False
+        # Mattermost leaves out an empty auth_data, e.g. of the email users
+        if not user.get('auth_data'):
+            mm.driver.users.update_user_authentication_method(
+                user['id'], {'auth_data': user['username'], 'auth_service': 'ldap'})
+            changed = True
+        if user.get('delete_at'):
+            mm.driver.users.update_user_active_status(user['id'], {'active': True})
+            changed = True
+        return changed
+
+    @staticmethod
+    def deactivate_user(mm, user):
+        if user.get('delete_at'):
+            return False
+        mm.driver.users.update_user_active_status(user['id'], {'active': False})
+        return True
+
+    @staticmethod
+    def update_user(mm, user, nickname=None, ldap_auth=False):
+        changed = False
+        if nickname is not None and user.get('nickname') != nickname:
+            mm.driver.users.patch_user(user['id'], {'nickname': nickname})
+            changed = True
+        if ldap_auth and (user.get('auth_service') != 'ldap' or not user.get('auth_data')):
+            mm.driver.users.update_user_authentication_method(
+                user['id'], {'auth_data': user['username'], 'auth_service': 'ldap'})
+            changed = True
+        return changed
+
+    @staticmethod
+    def protected_user(mm, user):
+        """Whether the user is the bot itself or a system admin, who are left out of the changes by LDAP filter"""
+        return user['id'] == mm.driver.client.userid or 'system_admin' in (user.get('roles') or '').split()
+
+    def team_list(self, mm):
+        """List all teams, also a generator"""
+        # send the teams as they are fetched, in messages as large as the chat allows
+        report = self.output_aggregator()
+        listed = 0
+        for teams in paginate(
+                lambda page, per_page: mm.driver.teams.get_teams({'page': page, 'per_page': per_page}),
+                lambda: mm.driver.teams.get_teams({'include_total_count': True, 'per_page': 1})['total_count'],
+                self.config['MM_PAGE_WORKERS']):
+            if not teams:
+                continue
+            if not listed:
+                for msg in report.add('OK, here is a list of teams:', 'Name - Display Name'):
+                    yield msg
+            for msg in report.add(*['{} - {}'.format(t['name'], t['display_name']) for t in teams]):
+                yield msg
+            listed += len(teams)
+
+        for msg in report.flush():
+            yield msg
+        yield 'That\'s {} teams in total.'.format(listed) if listed else 'I don\'t see any team.'
 
     def init_mm(self, token):
-        mm = Sync({
+        """Get a logged in Sync object for the token, reuse the one from the previous calls when possible"""
+        self.load_clients()
+        with self.session_lock:
+            mm = self.sessions.get(token)
+            if mm is None:
+                with self.metrics.timer('init_mm_seconds', cached='no'):
+                    mm = self.create_mm(token)
+                self.sessions.set(token, mm)
+            else:
+                self.metrics.observe('init_mm_seconds', 0, cached='yes')
+
+        return mm
+
+    def create_mm(self, token):
+        mm = self.create_sync(token)
+        self.hook_driver(mm, token)
+        mm.driver.login()
+        # the LDAP connection of mm is the first one of the pool, the others are only used for LDAP. When it breaks,
+        # mm is still used for the Mattermost API
+        mm.ldap_pool = LdapPool(lambda: self.create_sync(token), self.config['LDAP_POOL_SIZE'], [mm], [CourseNotFound])
+
+        return mm
+
+    def create_sync(self, token):
+        return Sync({
             'url': self.config['MM_URL'],
             'token': self.fernet.decrypt(token.encode('utf-8')).decode('utf-8'),
             'port': self.config['MM_PORT'],
@@ -545,84 +2006,1089 @@ class Mattermost(BotPlugin):
             'bind_password': self.fernet.decrypt(
                 self.config['LDAP_BIND_ENCRYPTED_PASSWORD'].encode('utf-8')).decode('utf-8')
         })
-        mm.driver.login()
 
-        return mm
+    @contextmanager
+    def ldap_connection(self, mm):
+        """
+        A Sync object to query LDAP with, from the pool of the session of mm. A connection failing with anything but
+        CourseNotFound is not used again
+        """
+        pool = getattr(mm, 'ldap_pool', None)
+        try:
+            if pool is None:
+                with self.ldap_lock:
+                    yield mm
+            else:
+                with pool.connection() as conn:
+                    yield conn
+        except CourseNotFound:
+            raise
+        except Exception:
+            if pool is not None:
+                # the pool drops the connection, e.g. a stale bind is not used until MM_SESSION_TTL is up
+                self.log.warning('Dropped an LDAP connection after a failed query, a new one is made next time')
+                self.metrics.inc('ldap_connections_dropped_total')
+            raise
+
+    def hook_driver(self, mm, token):
+        """Wrap the requests made by the driver, all the Mattermost API calls go through it"""
+        make_request = mm.driver.client.make_request
+
+        def request(method, endpoint, *args, **kwargs):
+            endpoint_name = endpoint
+            for pattern, repl in self.ENDPOINT_PATTERNS:
+                endpoint_name = pattern.sub(repl, endpoint_name)
+            labels = {'method': method.lower(), 'endpoint': endpoint_name}
+            attempt = 0
+            while True:
+                self.rate_limiter.acquire()
+                status = 'error'
+                try:
+                    with self.metrics.timer('mm_api_seconds', **labels):
+                        response = make_request(method, endpoint, *args, **kwargs)
+                    status = 'ok'
+                except NoAccessTokenProvided:
+                    # the token is revoked or the session is expired, login again next time
+                    self.sessions.pop(token)
+                    raise
+                except HTTPError as e:
+                    if e.response is None or e.response.status_code != 429 or \
+                            attempt >= self.config['MM_MAX_RETRIES']:
+                        raise
+                    status = 'throttled'
+                    self.rate_limiter.update(e.response.headers)
+                    delay = self.retry_delay(e.response.headers, attempt)
+                finally:
+                    self.metrics.inc('mm_api_calls_total', status=status, **labels)
+
+                if status == 'ok':
+                    self.rate_limiter.update(response.headers)
+                    return response
+                self.log.warning('Mattermost API is rate limited, retrying {} {} in {:.1f}s'.format(
+                    method.upper(), endpoint_name, delay))
+                time.sleep(delay)
+                attempt += 1
+
+        mm.driver.client.make_request = request
+
+    @staticmethod
+    def retry_delay(headers, attempt):
+        """Seconds to wait before retrying a rate limited request, with jitter so the workers don't retry together"""
+        delay = headers.get('Retry-After') or headers.get('X-Ratelimit-Reset')
+        delay = float(delay) if delay else min(0.5 * 2 ** attempt, 30)
+        return delay + random.uniform(0, delay / 2)
+
+    def sync(self, courses, mm, full=False, checkpoint=None, report=None, job=None):
+        """
+        Actual sync function, also a generator. When a checkpoint name is given, the progress is stored under it and an
+        unfinished run under the same name is resumed instead of starting over with the courses. When an
+        OutputAggregator is given as report, the messages of the courses go to it and only the progress is yielded.
+        When the job is cancelled, the courses not started yet are left for the next run.
+        """
+        self.metrics.inc('sync_runs_total')
+        if checkpoint is not None:
+            state, resumed = self.start_checkpoint(checkpoint, courses)
+            # the courses removed from the mapping since the run started are left out
+            courses = [c for c in state['courses'] if c not in state['done'] and
+                       (not resumed or c in self.course_mappings)]
+            if resumed:
+                yield 'Resuming sync run {}, {} of {} courses are done already.'.format(
+                    state['run_id'], len(state['done']), len(state['courses']))
+
+        # leave the courses being synced by another job or the scheduler to them
+        claimed = self.jobs.claim(courses, 'job {}'.format(job.id) if job is not None else 'another sync')
+        skipped = ['{} by {}'.format(c, self.jobs.owner(c)) for c in courses if c not in claimed]
+        courses = claimed
+
+        def cancelled():
+            return job is not None and job.cancelled.is_set()
+
+        # cross-listed courses share sections, look up each section only once per run, and students take many
+        # courses, look up each student only once per run
+        run_cache = {}
+        user_index = UserIndex(self.user_cache)
+
+        def sync_course(course):
+            # a failing course is reported and the rest of the courses carry on, whichever way they are run
+            record = {}
+            start = time.monotonic()
+            try:
+                with self.metrics.timer('sync_course_seconds', course=course):
+                    for msg in self.sync_course(course, mm, full, run_cache, checkpoint, user_index, record):
+                        yield msg
+            except Exception as e:
+                self.log.exception('Failed to sync course {}'.format(course))
+                self.metrics.inc('sync_errors_total', course=course)
+                self.update_checkpoint(checkpoint, course, 'failed')
+                yield 'Failed to sync course {}: {}'.format(course, e)
+            finally:
+                self.record_sync(course, time.monotonic() - start, record)
+                if job is not None:
+                    job.synced.add(course)
 
-    def sync(self, courses, mm):
-        """Actual sync function, also a generator"""
-        for course in courses:
+        try:
+            # the claims are released even when the consumer stops here
+            if skipped:
+                yield 'Skipped {} courses being synced already: {}'.format(len(skipped), ', '.join(skipped))
+            workers = min(self.config['SYNC_WORKERS'], len(courses))
+            if workers <= 1:
+                for course in courses:
+                    if cancelled():
+                        break
+                    msgs = sync_course(course)
+                    for msg in report.course(course, list(msgs)) if report else msgs:
+                        yield msg
+            else:
+                # sync the courses concurrently, the messages of a course are yielded together once the course is done
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mm-sync') as executor:
+                    futures = dict((executor.submit(lambda c: None if cancelled() else list(sync_course(c)), course),
+                                    course) for course in courses)
+                    for future in as_completed(futures):
+                        msgs = future.result()
+                        if msgs is None:
+                            continue
+                        for msg in report.course(futures[future], msgs) if report else msgs:
+                            yield msg
+        finally:
+            self.jobs.release(courses)
+            self.save_sync_history()
+
+        if cancelled():
+            yield 'Sync is cancelled, the courses not synced yet are left for the next run.'
+        elif checkpoint is not None:
+            self.finish_checkpoint(checkpoint)
+
+    def sync_course(self, course, mm, full=False, run_cache=None, checkpoint=None, user_index=None, record=None):
+        """
+        Sync a single course to its team, also a generator. The sections of a cross-listed course are loaded
+        concurrently, and the students of a section are created and added while the other sections are still loading.
+        The numbers of the sync and its outcome are filled in record, for the sync history
+        """
+        record = {} if record is None else record
+        source_courses, team_name = self.parse_mapping(course)
+        yield 'OK, syncing course(s) {} to team {}.'.format(source_courses, team_name)
+
+        # with a roster from the last sync, only the students joined since then need to be created and added. Adding a
+        # user who is already in the team is a no-op in Mattermost, so there is no need to page through the members
+        snapshot = None
+        if self.config['SYNC_INCREMENTAL'] and not full:
+            snapshot = self.get_roster_snapshot(course)
+
+        self.update_checkpoint(checkpoint, course, 'ldap')
+        course_members = []
+        # the students of the course without the duplicates of cross-listed sections
+        roster = []
+        team = None
+        members = None
+        existing_users = []
+        failed_users = []
+        created_users = []
+        # the dropped students who should be removed but are not yet
+        pending_ids = set()
+        added = 0
+        record.update(status='failed', created=created_users)
+        try:
+            for section_members, new_in_section in self.stream_course_members(mm, source_courses, run_cache):
+                course_members.extend(section_members)
+                roster.extend(new_in_section)
+                if snapshot:
+                    new_members = [m for m in new_in_section if member_key(m) not in snapshot['members']]
+                else:
+                    new_members = new_in_section
+                if not new_members:
+                    continue
+
+                if team is None:
+                    self.update_checkpoint(checkpoint, course, 'team')
+                    team, created = self.get_course_team(mm, course, team_name, full)
+                    if created:
+                        yield 'Team {} is created.'.format(team_name)
+                        # nobody is in a new team, add everyone loaded so far
+                        snapshot = None
+                        members = []
+                        new_members = list(roster)
+                    else:
+                        yield 'Team {} already exists.'.format(team_name)
+                    yield 'Now adding students to the team...'
+                self.update_checkpoint(checkpoint, course, 'users')
+                if members is None and not snapshot:
+                    # check if the users are already in the team
+                    members = self.get_all_team_members(mm, team)
+                users, failed = self.resolve_users(mm, new_members, user_index, created_users)
+                existing_users.extend(users)
+                failed_users.extend(failed)
+                if not snapshot:
+                    diff = RosterDiff(RosterDiff.from_users(users), RosterDiff.from_members(members))
+                    users = [u for u in users if u['id'] in diff.to_add]
 
-            source_courses, team_name = parse_course(course)
-            yield 'OK, syncing course(s) {} to team {}.'.format(source_courses, team_name)
+                # add the missing ones
+                if users:
+                    self.update_checkpoint(checkpoint, course, 'members')
+                    mm.add_users_to_team(users, team['id'])
+                    added += len(users)
+                    record['added'] = added
+
+            # compare the roster with the one from the last sync, nothing is added when it is unchanged
+            record['ldap'] = len(roster)
+            current_hash = roster_hash(course_members)
+            if snapshot and snapshot['hash'] == current_hash:
+                self.metrics.inc('sync_courses_skipped_total', course=course)
+                record['status'] = 'unchanged'
+                self.update_checkpoint(checkpoint, course, 'unchanged')
+                yield 'Roster of course {} is unchanged since last sync. Skipped.'.format(course)
+                return
 
-            try:
-                course_members = []
-                for c in source_courses:
-                    course_members.extend(mm.get_member_from_ldap(
-                        self.config['LDAP_SEARCH_BASE'],
-                        *c))
-            except CourseNotFound as e:
-                yield e
-                continue
+            if team is None:
+                # no student to add, the team is still needed to remove the dropped ones
+                self.update_checkpoint(checkpoint, course, 'team')
+                team, created = self.get_course_team(mm, course, team_name, full)
+                yield ('Team {} is created.' if created else 'Team {} already exists.').format(team_name)
+                if created:
+                    snapshot = None
+                    members = []
+
+            if snapshot:
+                current_keys = set(member_key(m) for m in roster)
+                synced = dict((k, v) for k, v in snapshot['members'].items() if k in current_keys)
+                dropped_ids = [v for k, v in snapshot['members'].items() if k not in current_keys]
+                if self.config['SYNC_REMOVE'] and dropped_ids:
+                    dropped = mm.driver.teams.get_team_members_by_id(team['id'], dropped_ids)
+                else:
+                    dropped = []
+            else:
+                synced = {}
+                if members is None:
+                    members = self.get_all_team_members(mm, team)
+                diff = RosterDiff(RosterDiff.from_users(existing_users), RosterDiff.from_members(members))
+                dropped = [m for m in members if m['user_id'] in diff.to_remove]
+
+            self.metrics.inc('sync_users_resolved_total', len(existing_users), course=course)
+            self.metrics.inc('sync_users_failed_total', len(failed_users), course=course)
+            self.metrics.inc('sync_users_added_total', added, course=course)
+            record['failed'] = len(failed_users)
+            if failed_users:
+                yield 'Warning: failed to add {} students to Mattermost. Please check the logs for details.'.format(
+                    len(failed_users)
+                )
+            if added:
+                yield 'Added {} students to the team {}.'.format(added, team_name)
+            else:
+                yield 'No new student to add. Roster is up-to-date.'
+            if added or snapshot:
+                self.course_changed_at[course] = time.time()
+
+            # without the failed students we can't tell who is dropped from the course, leave the team as is
+            if self.config['SYNC_REMOVE'] and dropped and failed_users:
+                pending_ids.update(m['user_id'] for m in dropped)
+            elif self.config['SYNC_REMOVE'] and dropped:
+                self.update_checkpoint(checkpoint, course, 'remove')
+                for msg in self.remove_dropped_members(mm, course, team, dropped, record, pending_ids):
+                    yield msg
+        except CourseNotFound as e:
+            # the students of the sections loaded before are added already, they are synced again next time
+            record['status'] = 'not found'
+            self.update_checkpoint(checkpoint, course, 'not found')
+            yield e
+            return
+        except HTTPError as e:
+            # the cached team id is gone when the team is deleted, look the team up again next time and sync the
+            # new team in full
+            if isinstance(e, ResourceNotFound):
+                self.update_mapping(course, team_id=None)
+                self.clear_roster_snapshot(course)
+            # so may be a cached user
+            for member in course_members:
+                self.user_cache.pop(member_key(member))
+            # only this team is failed, carry on with the rest of the courses
+            self.metrics.inc('sync_errors_total', course=course)
+            self.update_checkpoint(checkpoint, course, 'failed')
+            self.log.error('Failed to sync team {}: {}'.format(team_name, e.args))
+            yield 'Failed to sync team {}: {}'.format(team_name, e.args)
+            return
 
-            try:
+        # remember the synced roster, leave the hash out when some students failed or some dropped ones are still in
+        # the team, so they are tried again next time. The dropped ones stay in the roster until they are removed, a
+        # full sync finds them in the team members instead
+        synced.update((member_key(u), u['id']) for u in existing_users)
+        if not pending_ids:
+            self.set_roster_snapshot(course, None if failed_users else current_hash, synced)
+        elif snapshot:
+            synced.update((k, v) for k, v in snapshot['members'].items() if v in pending_ids)
+            self.set_roster_snapshot(course, None, synced)
+        else:
+            self.clear_roster_snapshot(course)
+        self.update_mapping(course, last_sync=time.time(), team_id=team['id'])
+        record['status'] = 'done'
+        self.update_checkpoint(checkpoint, course, 'done')
+        yield 'Finished to sync course {}.'.format(course)
+
+    def get_course_team(self, mm, course, team_name, full=False):
+        """
+        The team of the course and whether it is just created. The team id is cached with the course mapping, the team
+        is looked up only when it is not known yet or when full
+        """
+        team_id = self.course_mappings.get(course, {}).get('team_id')
+        if team_id and not full:
+            return {'id': team_id, 'name': team_name}, False
+        team = mm.get_team_by_name(team_name)
+        if team:
+            return team, False
+        return mm.create_team(team_name), True
+
+    def get_all_team_members(self, mm, team):
+        """All the members of the team, the pages are fetched concurrently"""
+        members = []
+        for m in paginate(
+                lambda page, per_page: mm.get_team_members(team['id'], {'page': page, 'per_page': per_page}),
+                lambda: mm.driver.teams.get_team_stats(team['id'])['total_member_count'],
+                self.config['MM_PAGE_WORKERS']):
+            members.extend(m)
+        return members
+
+    def plan(self, courses, mm, full=False, report=None):
+        """
+        Dry run of sync, also a generator. Works out what the sync would do with read calls only, and estimates the
+        API calls and the time it would take. The report is used the same way as in sync
+        """
+        run_cache = {}
+        new_users = set()
+        plans = []
+        workers = max(min(self.config['SYNC_WORKERS'], len(courses)), 1)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mm-plan') as executor:
+            for plan in executor.map(lambda c: self.plan_course(c, mm, full, run_cache, new_users), courses):
+                plans.append(plan)
+                if plan['status'] == 'planned':
+                    msg = 'Course {} to team {}: {}create {} users, add {} and remove {} members, {} API ' \
+                          'calls.{}'.format(
+                              plan['course'], plan['team'], 'create the team, ' if plan['create_team'] else '',
+                              plan['create_users'], plan['add'], plan['remove'], plan['calls'],
+                              ' Nobody is removed, more than SYNC_REMOVE_MAX students are dropped.'
+                              if plan['remove_blocked'] else
+                              ' Nobody is removed, the team is synced from other courses as well.'
+                              if plan['remove_shared'] else '')
+                elif plan['status'] == 'failed':
+                    msg = 'Failed to plan the sync of course {}: {}'.format(plan['course'], plan['error'])
+                else:
+                    msg = 'Course {}: {}, nothing to do.'.format(plan['course'], plan['status'])
+                for m in report.course(plan['course'], [msg]) if report else [msg]:
+                    yield m
+
+        def total(field):
+            return sum(p[field] for p in plans)
+
+        calls = total('calls')
+        yield 'Dry run of {} courses, {} unchanged, {} not found, {} failed. The sync would create {} teams and {} ' \
+              'users, add {} and remove {} team members with {} API calls, in about {:.0f}s.'.format(
+                  len(plans), sum(1 for p in plans if p['status'] == 'unchanged'),
+                  sum(1 for p in plans if p['status'] == 'not found'),
+                  sum(1 for p in plans if p['status'] == 'failed'), total('create_team'), total('create_users'),
+                  total('add'), total('remove'), calls, self.estimate_duration(calls))
+
+    def plan_course(self, course, mm, full=False, run_cache=None, new_users=None):
+        """
+        Work out what sync_course would do for the course with read calls only. Returns a dict with the status, the
+        team and the number of users to create, add and remove, and the number of API calls the sync would make.
+        new_users collects the usernames to create across the courses of a run, so each one is counted once
+        """
+        source_courses, team_name = self.parse_mapping(course)
+        plan = {'course': course, 'team': team_name, 'status': 'planned', 'error': None, 'create_team': False,
+                'create_users': 0, 'add': 0, 'remove': 0, 'remove_blocked': False, 'remove_shared': False,
+                'calls': 0}
+        try:
+            course_members = list(chain.from_iterable(
+                members for members, _ in self.stream_course_members(mm, source_courses, run_cache)))
+        except CourseNotFound:
+            plan['status'] = 'not found'
+            return plan
+
+        snapshot = None
+        if self.config['SYNC_INCREMENTAL'] and not full:
+            snapshot = self.get_roster_snapshot(course)
+        if snapshot and snapshot['hash'] == roster_hash(course_members):
+            plan['status'] = 'unchanged'
+            return plan
+
+        # the same steps as sync_course, counting the calls it would make instead of writing
+        calls = 0
+        try:
+            team_id = self.course_mappings.get(course, {}).get('team_id')
+            if not team_id or full:
+                calls += 1
                 team = mm.get_team_by_name(team_name)
-                if team:
-                    yield 'Team {} already exists.'.format(team_name)
+                team_id = team['id'] if team else None
+            if not team_id:
+                plan['create_team'] = True
+                calls += 1
+                snapshot = None
+
+            if snapshot:
+                current_keys = set(member_key(m) for m in course_members)
+                candidates = [m for m in course_members if member_key(m) not in snapshot['members']]
+            else:
+                candidates = course_members
+            usernames = [member_key(m) for m in candidates]
+            # looked up in batches like the sync does
+            existing_users = self.lookup_users(mm, usernames)
+            missing = set(usernames) - set(member_key(u) for u in existing_users)
+            if new_users is not None:
+                # the students of cross-listed courses are created by whichever course comes first
+                missing -= new_users
+                new_users.update(missing)
+            plan['create_users'] = len(missing)
+            calls += math.ceil(len(usernames) / MAX_PAGE_SIZE) + len(missing)
+
+            dropped = []
+            if snapshot:
+                plan['add'] = len(candidates)
+                dropped_ids = [v for k, v in snapshot['members'].items() if k not in current_keys]
+                if self.config['SYNC_REMOVE'] and dropped_ids:
+                    calls += 1
+                    dropped = mm.driver.teams.get_team_members_by_id(team_id, dropped_ids)
+            elif team_id:
+                reads = []
+
+                def fetch(page, per_page):
+                    reads.append(page)
+                    return mm.get_team_members(team_id, {'page': page, 'per_page': per_page})
+
+                def total_count():
+                    reads.append('stats')
+                    return mm.driver.teams.get_team_stats(team_id)['total_member_count']
+
+                members = list(chain.from_iterable(paginate(fetch, total_count, self.config['MM_PAGE_WORKERS'])))
+                calls += len(reads)
+                diff = RosterDiff(RosterDiff.from_users(existing_users), RosterDiff.from_members(members))
+                plan['add'] = len(diff.to_add) + len(set(usernames) - set(member_key(u) for u in existing_users))
+                dropped = [m for m in members if m['user_id'] in diff.to_remove]
+            else:
+                # the members of a new team are read once, it is empty
+                calls += 1
+                plan['add'] = len(course_members)
+            calls += math.ceil(plan['add'] / MAX_PAGE_SIZE)
+
+            if self.config['SYNC_REMOVE'] and dropped and self.shared_team_courses(course, team_name):
+                plan['remove_shared'] = True
+            elif self.config['SYNC_REMOVE'] and dropped:
+                user_ids = self.removable_members(mm, dropped)
+                if len(user_ids) > self.config['SYNC_REMOVE_MAX']:
+                    plan['remove_blocked'] = True
                 else:
-                    team = mm.create_team(team_name)
-                    yield 'Team {} is created.'.format(team_name)
-                yield 'Now adding students to the team...'
-                existing_users, failed_users = mm.create_users(course_members)
-                if failed_users:
-                    yield 'Warning: failed to add {} students to Mattermost. Please check the logs for details.'.format(
-                        len(failed_users)
-                    )
-
-                # check if the users are already in the team
-                members = []
-                for i in range(1000):
-                    m = mm.get_team_members(team['id'], {'page': i, 'per_page': 60})
-                    if m:
-                        members.extend(m)
-                        continue
-
-                    if len(m) < 60:
-                        break
-                member_ids = [m['user_id'] for m in members]
-                users_to_add = []
-                for u in existing_users:
-                    if u['id'] not in member_ids:
-                        users_to_add.append(u)
+                    plan['remove'] = len(user_ids)
+                    calls += len(user_ids)
+        except HTTPError as e:
+            plan['status'] = 'failed'
+            plan['error'] = e.args
+        plan['calls'] = calls
+        return plan
+
+    def estimate_duration(self, calls):
+        """Rough seconds the API calls take, from the observed latency of the calls, the workers and the rate limit"""
+        api = self.metrics.timers('mm_api_seconds')
+        observed = sum(v[0] for v in api.values())
+        latency = sum(v[1] for v in api.values()) / observed if observed else DEFAULT_API_SECONDS
+        seconds = calls * latency / max(self.config['SYNC_WORKERS'], 1)
+        if self.config['MM_RATE_LIMIT']:
+            seconds = max(seconds, (calls - self.config['MM_RATE_BURST']) / self.config['MM_RATE_LIMIT'])
+        return seconds
+
+    def resolve_users(self, mm, members, user_index=None, created=None):
+        """
+        Mattermost users of the LDAP members, the missing ones are created and appended to created when it is given.
+        Returns the users and the members failed to be created. The user index of the run resolves every person only
+        once
+        """
+        if user_index is None:
+            user_index = UserIndex(self.user_cache)
+
+        def create(missing):
+            users, failed = mm.create_users(missing)
+            if created is not None:
+                created.extend(users)
+            return users, failed
+
+        return user_index.resolve(members, lambda usernames: self.lookup_users(mm, usernames), create)
+
+    def lookup_users(self, mm, usernames):
+        """Existing Mattermost users of the usernames, looked up in batches"""
+        users = []
+        for i in range(0, len(usernames), MAX_PAGE_SIZE):
+            users.extend(mm.driver.users.get_users_by_usernames(usernames[i:i + MAX_PAGE_SIZE]))
+        self.metrics.inc('sync_users_looked_up_total', len(usernames))
+        return users
+
+    def stream_course_members(self, mm, sections, run_cache=None):
+        """
+        Load the LDAP members of the course sections, a generator of the members of each section together with the ones
+        not in the sections loaded before, in the order the sections are loaded. Up to LDAP_POOL_SIZE sections are
+        queried at a time
+        """
+        seen = set()
+
+        def merge(members):
+            new_members = []
+            for m in members:
+                key = member_key(m)
+                if key not in seen:
+                    seen.add(key)
+                    new_members.append(m)
+            return members, new_members
+
+        workers = min(self.config['LDAP_POOL_SIZE'], len(sections))
+        if workers <= 1:
+            for section in sections:
+                yield merge(self.get_course_members(mm, section, run_cache))
+            return
 
-                # add the missing ones
-                if users_to_add:
-                    mm.add_users_to_team(users_to_add, team['id'])
-                    yield 'Added {} students to the team {}.'.format(len(users_to_add), team_name)
-                else:
-                    yield 'No new student to add. Roster is up-to-date.'
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mm-ldap') as executor:
+            futures = [executor.submit(self.get_course_members, mm, section, run_cache) for section in sections]
+            try:
+                for future in as_completed(futures):
+                    yield merge(future.result())
+            finally:
+                # a missing section fails the course, don't wait for the sections not queried yet
+                for future in futures:
+                    future.cancel()
+
+    def get_course_members(self, mm, section, run_cache=None):
+        """
+        Get the LDAP members of a course section. The members are cached for LDAP_CACHE_TTL seconds and for the
+        whole sync run, a missing course is cached for LDAP_NEGATIVE_CACHE_TTL seconds.
+        """
+        key = tuple(section)
+        result = run_cache.get(key) if run_cache is not None else None
+        if result is None:
+            result = self.ldap_cache.get(key)
+        if result is None:
+            with self.section_locks_lock:
+                lock = self.section_locks[key]
+            with lock:
+                # another sync worker may have looked it up while we were waiting
+                result = run_cache.get(key) if run_cache is not None else None
+                if result is None:
+                    result = self.ldap_cache.get(key)
+                if result is None:
+                    try:
+                        with self.ldap_connection(mm) as ldap, self.metrics.timer('ldap_query_seconds', query='course'):
+                            result = ldap.get_member_from_ldap(self.config['LDAP_SEARCH_BASE'], *section)
+                        self.ldap_cache.set(key, result)
+                    except CourseNotFound as e:
+                        result = e
+                        self.ldap_cache.set(key, e, self.config['LDAP_NEGATIVE_CACHE_TTL'])
+                if run_cache is not None:
+                    run_cache[key] = result
+        elif run_cache is not None:
+            run_cache[key] = result
+
+        if isinstance(result, CourseNotFound):
+            raise result
+        return result
+
+    def removable_members(self, mm, members):
+        """User ids of the team members who can be removed, leaving out the exempt ones and the bot itself"""
+        exempt_roles = set(self.config['SYNC_REMOVE_EXEMPT_ROLES'])
+        return [
+            m['user_id'] for m in members
+            if not m.get('delete_at') and not m.get('scheme_admin') and m['user_id'] != mm.driver.client.userid and
+            not exempt_roles & set((m.get('roles') or '').split())
+        ]
+
+    def remove_dropped_members(self, mm, course, team, members, record=None, pending=None):
+        """
+        Remove the team members who are dropped from the course, also a generator. Counts them in record, and adds the
+        user ids which should be removed but are not to pending, so they are tried again next time
+        """
+        # the students of the other courses synced to the team are not in the roster of this one, so nobody can tell
+        # who is dropped
+        shared = self.shared_team_courses(course, team['name'])
+        if shared:
+            yield 'Warning: team {} is synced from course(s) {} as well. Nobody is removed, please remove the ' \
+                  'dropped students by hand.'.format(team['name'], ', '.join(shared))
+            return
+        user_ids = self.removable_members(mm, members)
+        if not user_ids:
+            return
+        if len(user_ids) > self.config['SYNC_REMOVE_MAX']:
+            yield 'Warning: {} students are dropped from team {}, which is more than SYNC_REMOVE_MAX ({}). ' \
+                  'Nobody is removed, please check the course roster.'.format(
+                      len(user_ids), team['name'], self.config['SYNC_REMOVE_MAX'])
+            if pending is not None:
+                pending.update(user_ids)
+            return
+
+        def remove(user_id):
+            try:
+                mm.driver.teams.remove_user_from_team(team['id'], user_id)
             except HTTPError as e:
-                self.log.error('Failed to sync team {}: {}'.format(team_name, e.args))
-                yield 'Failed to sync team {}: {}'.format(team_name, e.args)
+                self.log.error('Failed to remove user {} from team {}: {}'.format(user_id, team['name'], e.args))
+                return False
+            return True
+
+        # there is no bulk removal API, send the removals in concurrent batches instead
+        with ThreadPoolExecutor(self.config['SYNC_REMOVE_BATCH'], thread_name_prefix='mm-remove') as executor:
+            results = list(executor.map(remove, user_ids))
+        removed = sum(results)
+        if pending is not None:
+            pending.update(user_id for user_id, ok in zip(user_ids, results) if not ok)
+        self.metrics.inc('sync_users_removed_total', removed, course=course)
+        if record is not None:
+            record['removed'] = removed
+        yield 'Removed {} dropped students from the team {}.'.format(removed, team['name'])
+        if removed < len(user_ids):
+            yield 'Warning: failed to remove {} students from team {}. Please check the logs for details.'.format(
+                len(user_ids) - removed, team['name'])
+
+    def shared_team_courses(self, course, team_name):
+        """The other mapped courses synced to the same team as the course"""
+        courses = []
+        for other in sorted(self.course_mappings):
+            if other == course:
+                continue
+            try:
+                if self.parse_mapping(other)[1].lower() == team_name.lower():
+                    courses.append(other)
+            except Exception:
+                # a broken course spec is reported by its own sync
+                continue
+        return courses
+
+    def get_checkpoint(self, name):
+        """Get the progress of the last sync run under the name, None if there is none"""
+        key = self.SYNC_CHECKPOINT_KEY.format(name)
+        with self.storage_lock:
+            state = self[key] if key in self else None
+            if state is None:
+                return None
+            state = dict(state)
+            # the runs stored by older versions keep the steps with the run
+            steps = dict(state.get('steps', {}))
+            for course in state['courses']:
+                step_key = self.SYNC_CHECKPOINT_STEP_KEY.format(name, course)
+                if step_key in self:
+                    run_id, step, updated = self[step_key]
+                    if run_id == state['run_id']:
+                        steps[course] = step
+                        state['updated'] = max(state['updated'], updated)
+        live = self.checkpoint_steps.get(name)
+        if live is not None and live['run_id'] == state['run_id']:
+            steps.update(live['steps'])
+            state['updated'] = max(state['updated'], live['updated'])
+        state['steps'] = steps
+        state['done'] = set(c for c, step in steps.items() if step in self.SYNC_DONE_STEPS)
+        return state
+
+    def resumable(self, state):
+        """Whether the sync run of the checkpoint state is unfinished and not resumed SYNC_MAX_RESUMES times yet"""
+        return state is not None and not state['finished'] and state.get('resumes', 0) < self.config['SYNC_MAX_RESUMES']
+
+    def start_checkpoint(self, name, courses):
+        """
+        Start a sync run with the courses, or resume the unfinished one. Returns the state and if it is resumed. A run
+        which still doesn't finish after SYNC_MAX_RESUMES resumes is given up, the courses start over
+        """
+        key = self.SYNC_CHECKPOINT_KEY.format(name)
+        state = self.get_checkpoint(name)
+        if self.resumable(state):
+            state['resumes'] = state.get('resumes', 0) + 1
+            self.store_checkpoint(key, state)
+            self.checkpoint_steps[name] = {'run_id': state['run_id'], 'steps': dict(state['steps']),
+                                           'updated': state['updated']}
+            return state, True
+        if state is not None and not state['finished']:
+            self.log.warning('Gave up sync run {} after {} resumes, starting over'.format(
+                state['run_id'], state.get('resumes', 0)))
+        self.clear_checkpoint(name)
+        now = time.time()
+        state = {'run_id': uuid.uuid4().hex[:8], 'started': now, 'updated': now, 'courses': list(courses),
+                 'finished': False, 'resumes': 0}
+        self.store_checkpoint(key, state)
+        self.checkpoint_steps[name] = {'run_id': state['run_id'], 'steps': {}, 'updated': now}
+        return dict(state, steps={}, done=set()), False
+
+    def store_checkpoint(self, key, state):
+        """Store the run of the state, without the steps of its courses"""
+        with self.storage_lock:
+            self[key] = dict((k, v) for k, v in state.items() if k not in ('steps', 'done'))
+
+    def update_checkpoint(self, name, course, step):
+        """
+        Record the step the course is at, if the sync run has a checkpoint. The steps are kept in memory, only the
+        last step of a course is stored, so a course costs one small write however many steps it goes through
+        """
+        if name is None:
+            return
+        live = self.checkpoint_steps.get(name)
+        if live is None:
+            return
+        now = time.time()
+        live['steps'][course] = step
+        live['updated'] = now
+        if step in self.SYNC_STORED_STEPS:
+            with self.storage_lock:
+                self[self.SYNC_CHECKPOINT_STEP_KEY.format(name, course)] = (live['run_id'], step, now)
+
+    def finish_checkpoint(self, name):
+        state = self.get_checkpoint(name)
+        state['finished'] = True
+        state['updated'] = time.time()
+        self.store_checkpoint(self.SYNC_CHECKPOINT_KEY.format(name), state)
+        self.checkpoint_steps.pop(name, None)
+
+    def clear_checkpoint(self, name):
+        """Remove the run under the name together with the steps of its courses"""
+        key = self.SYNC_CHECKPOINT_KEY.format(name)
+        self.checkpoint_steps.pop(name, None)
+        with self.storage_lock:
+            if key not in self:
+                return
+            for course in self[key]['courses']:
+                step_key = self.SYNC_CHECKPOINT_STEP_KEY.format(name, course)
+                if step_key in self:
+                    del self[step_key]
+            del self[key]
+
+    def load_storage(self):
+        """Load the tokens and the course mappings, moving them out of the single entries used by old versions"""
+        with self.storage_lock:
+            if 'tokens' in self:
+                for person, token in self['tokens'].items():
+                    self[self.TOKEN_KEY.format(person)] = token
+                del self['tokens']
+            if 'course_mappings' in self:
+                for course in self['course_mappings']:
+                    self[self.COURSE_MAPPING_KEY.format(course)] = self.new_mapping()
+                del self['course_mappings']
+
+            self.tokens = {}
+            self.course_mappings = {}
+            self.sync_history = {}
+            self.sync_history_changed = set()
+            self.checkpoint_steps = {}
+            for key in self.keys():
+                name = key.partition(':')[2]
+                if key == self.TOKEN_KEY.format(name):
+                    self.tokens[name] = self[key]
+                elif key == self.COURSE_MAPPING_KEY.format(name):
+                    self.course_mappings[name] = self[key]
+                elif key == self.SYNC_HISTORY_KEY.format(name):
+                    self.sync_history[name] = deque(self[key], self.config['SYNC_HISTORY_SIZE'])
+
+    @staticmethod
+    def new_mapping():
+        """Metadata of a newly mapped course, filled in by the syncs"""
+        return {'last_sync': None, 'team_id': None, 'source_courses': None, 'team_name': None}
+
+    def parse_mapping(self, course):
+        """Source courses and team name of the course spec, parsed once and cached with the course mapping"""
+        meta = self.course_mappings.get(course)
+        if meta and meta.get('team_name'):
+            return meta['source_courses'], meta['team_name']
+        self.load_clients()
+        source_courses, team_name = parse_course(course)
+        self.update_mapping(course, source_courses=list(source_courses), team_name=team_name)
+        return source_courses, team_name
+
+    def set_team_id(self, team_name, team_id):
+        """Update the cached team id of the courses mapped to the team, None drops it. The roster snapshot of the
+        courses is dropped with it, a new team is synced in full"""
+        for course, meta in list(self.course_mappings.items()):
+            if meta.get('team_name') == team_name and meta.get('team_id') != team_id:
+                self.update_mapping(course, team_id=team_id)
+                self.clear_roster_snapshot(course)
+
+    def add_mapping(self, course):
+        """Add the course to the course mappings, returns False if it is mapped already"""
+        with self.storage_lock:
+            if course in self.course_mappings:
+                return False
+            meta = self.new_mapping()
+            self[self.COURSE_MAPPING_KEY.format(course)] = meta
+            self.course_mappings[course] = meta
+            return True
+
+    def remove_mapping(self, course):
+        """Remove the course from the course mappings together with its roster snapshot and sync history"""
+        with self.storage_lock:
+            del self.course_mappings[course]
+            del self[self.COURSE_MAPPING_KEY.format(course)]
+            self.sync_history.pop(course, None)
+            self.sync_history_changed.discard(course)
+            for key in (self.ROSTER_SNAPSHOT_KEY.format(course), self.SYNC_HISTORY_KEY.format(course)):
+                if key in self:
+                    del self[key]
+
+    def update_mapping(self, course, **meta):
+        """Update the metadata of the course, nothing is stored if the course is not mapped"""
+        with self.storage_lock:
+            if course not in self.course_mappings:
+                return
+            self.course_mappings[course].update(meta)
+            self[self.COURSE_MAPPING_KEY.format(course)] = self.course_mappings[course]
+
+    def get_roster_snapshot(self, course):
+        """Get the roster of the course from the last sync, None if the course is never synced"""
+        key = self.ROSTER_SNAPSHOT_KEY.format(course)
+        with self.storage_lock:
+            return self[key] if key in self else None
+
+    def clear_roster_snapshot(self, course):
+        """Forget the roster of the course, the next sync compares the whole team"""
+        key = self.ROSTER_SNAPSHOT_KEY.format(course)
+        with self.storage_lock:
+            if key in self:
+                del self[key]
+
+    def set_roster_snapshot(self, course, digest, members):
+        """Store the synced roster of the course, members is a dict of username to user id"""
+        with self.storage_lock:
+            self[self.ROSTER_SNAPSHOT_KEY.format(course)] = {'hash': digest, 'members': members}
+
+    def record_sync(self, course, seconds, record):
+        """Append a sync of the mapped course to its history, the oldest one is dropped when the history is full"""
+        entry = (time.time(), seconds, record.get('ldap', 0), len(record.get('created', ())), record.get('added', 0),
+                 record.get('removed', 0), record.get('failed', 0), record.get('status', 'failed'))
+        with self.storage_lock:
+            if course not in self.course_mappings:
                 return
-            yield 'Finished to sync course {}.'.format(course)
+            if course not in self.sync_history:
+                self.sync_history[course] = deque(maxlen=self.config['SYNC_HISTORY_SIZE'])
+            self.sync_history[course].append(entry)
+            self.sync_history_changed.add(course)
+
+    def save_sync_history(self):
+        """Store the histories changed since the last call"""
+        with self.storage_lock:
+            for course in self.sync_history_changed:
+                if course in self.sync_history:
+                    self[self.SYNC_HISTORY_KEY.format(course)] = list(self.sync_history[course])
+            self.sync_history_changed = set()
+
+    def get_sync_history(self, course):
+        """The syncs of the course as dicts of SYNC_HISTORY_FIELDS, the oldest first"""
+        with self.storage_lock:
+            return [dict(zip(SYNC_HISTORY_FIELDS, entry)) for entry in self.sync_history.get(course, ())]
 
     def refresh(self):
-        """Refresh the team members"""
-        courses = self['course_mappings']
+        """Refresh the team members of the courses scheduled for this tick"""
+        # don't pile up the runs when a run takes longer than the interval, the tick is retried next time
+        if not self.refresh_lock.acquire(False):
+            self.log.warning('Previous sync is still running. Skipped this tick.')
+            return
 
-        mm = self.init_mm(self.config['MM_ENCRYPTED_ACCESS_TOKEN'])
+        try:
+            # finish the run interrupted by an error or a restart before moving on to the next shard. A dry run
+            # doesn't touch the checkpoint
+            dry_run = self.config['SYNC_DRY_RUN']
+            state = None if dry_run else self.get_checkpoint('refresh')
+            if self.resumable(state):
+                courses = state['courses']
+            else:
+                courses = self.scheduled_courses(self.refresh_tick)
+                self.refresh_tick += 1
+            if not courses:
+                return
 
-        for msg in self.sync(courses, mm):
-            self.log.info(msg)
+            mm = self.init_mm(self.config['MM_ENCRYPTED_ACCESS_TOKEN'])
+
+            # the scheduled run is listed with the jobs, so it can be followed and cancelled the same way
+            job = self.jobs.track('scheduled {}sync of {} courses'.format('dry run ' if dry_run else '', len(courses)),
+                                  'scheduler')
+            try:
+                run = self.plan(courses, mm) if dry_run else self.sync(courses, mm, checkpoint='refresh', job=job)
+                for msg in run:
+                    job.output.append(str(msg))
+                    self.log.info(msg)
+            except Exception:
+                self.jobs.finish(job, 'failed')
+                raise
+            self.jobs.finish(job)
+        finally:
+            self.refresh_lock.release()
 
         # self.send(self.build_identifier('#pan-test'), 'Sync completed!')
 
+    def ldap3_connection(self):
+        """A read only ldap3 connection, for the LDAP searches Sync can't do"""
+        try:
+            import ldap3
+        except ImportError:  # only the LDAP change watcher and the LDAP filters of the bulk commands need it
+            raise RuntimeError('ldap3 is needed to search LDAP, please install it')
+        return ldap3.Connection(
+            ldap3.Server(self.config['LDAP_URI']), user=self.config['LDAP_BIND_USER'],
+            password=self.fernet.decrypt(self.config['LDAP_BIND_ENCRYPTED_PASSWORD'].encode('utf-8')).decode('utf-8'),
+            auto_bind=True, read_only=True)
+
+    def create_change_feed(self):
+        return LdapChangeFeed(self.ldap3_connection(), self.config['LDAP_SEARCH_BASE'],
+                              self.config['LDAP_WATCH_FILTER'], self.config['LDAP_WATCH_ATTRIBUTE'],
+                              self.config['LDAP_GROUP_ATTRIBUTE'])
+
+    def search_usernames(self, ldap_filter):
+        """Lower cased usernames of the LDAP entries under LDAP_SEARCH_BASE matching the filter"""
+        attribute = self.config['LDAP_USERNAME_ATTRIBUTE']
+        connection = self.ldap3_connection()
+        try:
+            with self.metrics.timer('ldap_query_seconds', query='filter'):
+                entries = list(connection.extend.standard.paged_search(
+                    self.config['LDAP_SEARCH_BASE'], ldap_filter, attributes=[attribute], paged_size=MAX_PAGE_SIZE,
+                    generator=True))
+        finally:
+            connection.unbind()
+        return list(dict.fromkeys(
+            e['raw_attributes'][attribute][0].decode('utf-8').lower() for e in entries
+            if e.get('type') == 'searchResEntry' and e['raw_attributes'].get(attribute)))
+
+    def watch_changes(self, mm=None):
+        """
+        Sync the mapped courses whose LDAP groups changed since the last poll. The changed courses are pending until a
+        sync of the watcher picks them up, the ones skipped as being synced already are tried again on the next poll.
+        The refresh poller keeps sweeping all the courses as a fallback. Returns the job of the sync, None if nothing
+        is pending
+        """
+        try:
+            if self.change_feed is None:
+                self.change_feed = self.create_change_feed()
+            with self.storage_lock:
+                watermark = self[self.LDAP_WATERMARK_KEY] if self.LDAP_WATERMARK_KEY in self else None
+            with self.metrics.timer('ldap_query_seconds', query='changes'):
+                names, watermark = self.change_feed.poll(watermark)
+        except Exception as e:
+            # connect again on the next poll
+            self.change_feed = None
+            self.log.error('Failed to poll the LDAP changes: {}'.format(e))
+            return None
+
+        changed = self.changed_courses(names)
+        self.metrics.inc('ldap_changed_courses_total', len(changed))
+        seen = time.time()
+        # the watermark is stored with the pending courses, so a change is not lost when the sync is not done
+        with self.storage_lock:
+            pending = self[self.LDAP_PENDING_KEY] if self.LDAP_PENDING_KEY in self else {}
+            pending = dict((c, t) for c, t in pending.items() if c in self.course_mappings)
+            pending.update((c, seen) for c in changed)
+            self[self.LDAP_PENDING_KEY] = pending
+            if watermark is not None:
+                self[self.LDAP_WATERMARK_KEY] = watermark
+        if not pending:
+            return None
+        if mm is None:
+            mm = self.init_mm(self.config['MM_ENCRYPTED_ACCESS_TOKEN'])
+        courses = sorted(pending)
+        self.log.info('LDAP groups of {} courses changed, syncing them'.format(len(courses)))
+        return self.jobs.submit('sync of {} courses changed in LDAP'.format(len(courses)), 'watcher',
+                                lambda job: self.sync_changes(courses, mm, job), self.log.info)
+
+    def sync_changes(self, courses, mm, job):
+        """Sync the courses changed in LDAP, also a generator. The courses synced are no longer pending"""
+        try:
+            for msg in self.sync(courses, mm, job=job):
+                yield msg
+        finally:
+            # a course changed again after the job started is still pending, the job may have read it before
+            with self.storage_lock:
+                pending = self[self.LDAP_PENDING_KEY] if self.LDAP_PENDING_KEY in self else {}
+                self[self.LDAP_PENDING_KEY] = dict((c, t) for c, t in pending.items()
+                                                   if c not in job.synced or t >= job.started)
+
+    def group_name(self, section):
+        """Name of the LDAP group of a course section"""
+        return self.config['LDAP_GROUP_NAME'].format(*section, section='_'.join(section))
+
+    def changed_courses(self, names):
+        """
+        The mapped courses with a section among the changed LDAP group names. The cached members of the changed
+        sections are dropped, so the sync reads them again
+        """
+        names = set(n.lower() for n in names)
+        if not names:
+            return []
+        courses = []
+        for course in sorted(self.course_mappings):
+            try:
+                sections = [s for s in self.parse_mapping(course)[0] if self.group_name(s).lower() in names]
+            except Exception:
+                # a broken course spec is reported by the sync
+                continue
+            if sections:
+                for section in sections:
+                    self.ldap_cache.pop(tuple(section))
+                courses.append(course)
+        return courses
+
+    def refresh_interval(self):
+        """Seconds between the scheduler ticks, every course is synced once per SYNC_FREQUENCY"""
+        return self.config['SYNC_FREQUENCY'] / max(self.config['SYNC_SHARDS'], 1)
+
+    def scheduled_courses(self, tick):
+        """
+        Pick the courses to sync on the tick: the shard of the tick, led by its courses whose roster changed recently,
+        and in front of it the newly added courses never synced before. A new course is pulled forward once, if its
+        sync fails it waits for its shard like the rest. A course of the shard is left out until its own interval is
+        up, and each group is in SYNC_ORDER
+        """
+        shards = max(self.config['SYNC_SHARDS'], 1)
+        now = time.time()
+        new = []
+        changed = []
+        scheduled = []
+        for course, meta in sorted(self.course_mappings.items()):
+            history = self.get_sync_history(course)
+            if meta['last_sync'] is None and not history:
+                new.append(course)
+            elif int(hashlib.md5(course.encode('utf-8')).hexdigest(), 16) % shards == tick % shards:
+                # the shard comes round every SYNC_FREQUENCY, allow a tick of slack so a course is not left for a
+                # whole round when its interval is just about up
+                if history and now - history[-1]['time'] < self.course_interval(history) - self.refresh_interval():
+                    continue
+                if now - self.course_changed_at.get(course, 0) < self.config['SYNC_FREQUENCY']:
+                    changed.append(course)
+                else:
+                    scheduled.append(course)
+
+        return self.order_courses(new) + self.order_courses(changed) + self.order_courses(scheduled)
+
+    def course_interval(self, history):
+        """
+        Seconds between the scheduled syncs of a course with the history: SYNC_FREQUENCY, doubled for every sync in a
+        row that found the roster unchanged, up to SYNC_MAX_INTERVAL
+        """
+        frequency = self.config['SYNC_FREQUENCY']
+        quiet = min(self.sync_trend(history)['quiet'], 32)
+        return min(frequency * 2 ** quiet, max(self.config['SYNC_MAX_INTERVAL'], frequency))
+
+    @staticmethod
+    def sync_trend(history):
+        """Average sync seconds and students added or removed per sync of the history, and its unchanged streak"""
+        quiet = 0
+        for entry in reversed(history):
+            if entry['status'] != 'unchanged':
+                break
+            quiet += 1
+        return {
+            'seconds': sum(e['seconds'] for e in history) / len(history) if history else 0,
+            'changes': sum(e['added'] + e['removed'] for e in history) / len(history) if history else 0,
+            'quiet': quiet,
+        }
+
+    def order_courses(self, courses):
+        """
+        Order the courses by their sync history. With SYNC_ORDER slowest the courses taking the longest come first so
+        they don't hold up the end of a run, with changed the courses changing the most. Courses without a history go
+        first either way
+        """
+        field = {'slowest': 'seconds', 'changed': 'changes'}.get(self.config['SYNC_ORDER'])
+        if field is None:
+            return courses
+
+        def priority(course):
+            history = self.get_sync_history(course)
+            return self.sync_trend(history)[field] if history else float('inf')
+
+        return sorted(courses, key=priority, reverse=True)
+
     def change_user_active_statue(self, mm, username, active):
         try:
             user = mm.driver.users.get_user_by_username(username)
-            if active and not user['auth_data']:
+            if active and not user.get('auth_data'):
                 mm.driver.users.update_user_authentication_method(
                     user['id'], {'auth_data': username, 'auth_service': 'ldap'})
             mm.driver.users.update_user_active_status(user['id'], {'active': active})